@@ -32,6 +32,23 @@ def modinv(a, n):
         t1 += n
     return t1
 
+def modinv_many(values, n):
+    """Compute the modular inverses of a list of nonzero values modulo prime n
+
+    Uses Montgomery's trick: a single modinv plus 3 multiplications per value.
+    """
+    prods = []
+    acc = 1
+    for a in values:
+        prods.append(acc)
+        acc = (acc * a) % n
+    inv = modinv(acc, n)
+    ret = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        ret[i] = (inv * prods[i]) % n
+        inv = (inv * values[i]) % n
+    return ret
+
 def jacobi_symbol(n, k):
     """Compute the Jacobi symbol of n modulo k
 
@@ -99,6 +116,47 @@ class EllipticCurve:
         inv_3 = (inv_2 * inv) % self.p
         return ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
 
+    def affine_many(self, ps):
+        """Convert a list of Jacobian point tuples to affine form using a single modular inversion.
+
+        Uses Montgomery's trick; points at infinity map to None."""
+        ret = [None] * len(ps)
+        finite = [i for i, p1 in enumerate(ps) if p1[2] != 0]
+        for i, inv in zip(finite, modinv_many([ps[i][2] for i in finite], self.p)):
+            x1, y1, _ = ps[i]
+            inv_2 = (inv**2) % self.p
+            ret[i] = ((inv_2 * x1) % self.p, (inv_2 * inv * y1) % self.p, 1)
+        return ret
+
+    def sum_many(self, ps):
+        """Add a list of Jacobian point tuples. Returns an affine point or the point at infinity.
+
+        The points are normalised with one inversion, then added pairwise in
+        a tree of affine additions. Each level of the tree needs a single
+        batched inversion of all the slope denominators."""
+        pts = [p1 for p1 in self.affine_many(ps) if p1 is not None]
+        while len(pts) > 1:
+            pairs = []
+            denominators = []
+            for i in range(0, len(pts) - 1, 2):
+                (x1, y1, _), (x2, y2, _) = pts[i], pts[i + 1]
+                if x1 != x2:
+                    # Addition: slope (y2 - y1) / (x2 - x1).
+                    pairs.append((x1, y1, x2, (y2 - y1) % self.p))
+                    denominators.append((x2 - x1) % self.p)
+                elif y1 == y2 and y1 != 0:
+                    # Doubling: slope (3*x1^2 + a) / 2*y1.
+                    pairs.append((x1, y1, x2, (3 * x1 * x1 + self.a) % self.p))
+                    denominators.append((2 * y1) % self.p)
+                # Otherwise the points cancel out.
+            nxt = [pts[-1]] if len(pts) & 1 else []
+            for (x1, y1, x2, numerator), inv in zip(pairs, modinv_many(denominators, self.p)):
+                lam = (numerator * inv) % self.p
+                x3 = (lam * lam - x1 - x2) % self.p
+                nxt.append((x3, (lam * (x1 - x3) - y1) % self.p, 1))
+            pts = nxt
+        return pts[0] if pts else (0, 1, 0)
+
     def has_even_y(self, p1):
         """Whether the point p1 has an even Y coordinate when expressed in affine coordinates."""
         return not (p1[2] == 0 or self.affine(p1)[1] & 1)
@@ -224,6 +282,8 @@ class EllipticCurve:
 
         ps is a list of (Jacobian tuple, scalar) pairs.
         """
+        if len(ps) >= 8:
+            return self._mul_buckets(ps)
         r = (0, 1, 0)
         for i in range(255, -1, -1):
             r = self.double(r)
@@ -232,12 +292,122 @@ class EllipticCurve:
                     r = self.add(r, p)
         return r
 
+    def _mul_buckets(self, ps):
+        """Multi point multiplication with Pippenger's bucket method.
+
+        For each window of c scalar bits, points are added into the bucket of
+        their digit, and the buckets are summed weighted by their digit with
+        two running sums. This costs about 256/c * (len(ps) + 2**(c+1))
+        additions instead of 128 * len(ps)."""
+        c = max(2, len(ps).bit_length() - 3)
+        mask = (1 << c) - 1
+        r = (0, 1, 0)
+        for shift in range((255 // c) * c, -1, -c):
+            for _ in range(c):
+                r = self.double(r)
+            buckets = [(0, 1, 0)] * (mask + 1)
+            for (p, n) in ps:
+                digit = (n >> shift) & mask
+                if digit:
+                    buckets[digit] = self.add(buckets[digit], p)
+            running = (0, 1, 0)
+            acc = (0, 1, 0)
+            for digit in range(mask, 0, -1):
+                running = self.add(running, buckets[digit])
+                acc = self.add(acc, running)
+            r = self.add(r, acc)
+        return r
+
+    def fixed_base_table(self, p1, window=4):
+        """Precompute a table for repeated multiplication of the fixed point p1.
+
+        Entry [i][d - 1] is the affine point d * 2**(window*i) * p1, for
+        1 <= d < 2**window. See mul_fixed_base()."""
+        size = 1 << window
+        points = []
+        base = p1
+        for _ in range((256 + window - 1) // window):
+            row = [base]
+            for _ in range(size - 2):
+                row.append(self.add(row[-1], base))
+            points.extend(row)
+            base = self.add(row[-1], base)
+        points = self.affine_many(points)
+        return [points[i:i + size - 1] for i in range(0, len(points), size - 1)]
+
+    def mul_fixed_base(self, table, n):
+        """Multiply the point a fixed_base_table() was computed for by the scalar n < 2**256.
+
+        Needs no doublings, only one mixed addition per nonzero window."""
+        window = (len(table[0]) + 1).bit_length() - 1
+        mask = (1 << window) - 1
+        r = (0, 1, 0)
+        i = 0
+        while n:
+            d = n & mask
+            if d:
+                r = self.add(r, table[i][d - 1])
+            n >>= window
+            i += 1
+        return r
+
 SECP256K1_FIELD_SIZE = 2**256 - 2**32 - 977
 SECP256K1 = EllipticCurve(SECP256K1_FIELD_SIZE, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
+_secp256k1_g_table = None
+
+def secp256k1_g_table():
+    """Return the (lazily computed) fixed-base multiplication table for SECP256K1_G."""
+    global _secp256k1_g_table
+    if _secp256k1_g_table is None:
+        _secp256k1_g_table = SECP256K1.fixed_base_table(SECP256K1_G)
+    return _secp256k1_g_table
+
+def _parse_ecdsa_signature(sig, low_s=True):
+    """Return (r, s) of a strictly DER-encoded ECDSA signature, or None if it is invalid."""
+    # Extract r and s from the DER formatted signature. Return None for
+    # any DER encoding errors.
+    if (len(sig) < 4):
+        return None
+    if (sig[1] + 2 != len(sig)):
+        return None
+    if (sig[0] != 0x30):
+        return None
+    if (sig[2] != 0x02):
+        return None
+    rlen = sig[3]
+    if (len(sig) < 6 + rlen):
+        return None
+    if rlen < 1 or rlen > 33:
+        return None
+    if sig[4] >= 0x80:
+        return None
+    if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
+        return None
+    r = int.from_bytes(sig[4:4+rlen], 'big')
+    if (sig[4+rlen] != 0x02):
+        return None
+    slen = sig[5+rlen]
+    if slen < 1 or slen > 33:
+        return None
+    if (len(sig) != 6 + rlen + slen):
+        return None
+    if sig[6+rlen] >= 0x80:
+        return None
+    if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
+        return None
+    s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
+
+    # Verify that r and s are within the group order
+    if r < 1 or s < 1 or r >= SECP256K1_ORDER or s >= SECP256K1_ORDER:
+        return None
+    if low_s and s >= SECP256K1_ORDER_HALF:
+        return None
+    return r, s
+
 class ECPubKey():
     """A secp256k1 public key"""
 
@@ -326,44 +496,10 @@ class ECPubKey():
         ECDSA verifier algorithm"""
         assert(self.valid)
 
-        # Extract r and s from the DER formatted signature. Return false for
-        # any DER encoding errors.
-        if (sig[1] + 2 != len(sig)):
-            return False
-        if (len(sig) < 4):
-            return False
-        if (sig[0] != 0x30):
-            return False
-        if (sig[2] != 0x02):
-            return False
-        rlen = sig[3]
-        if (len(sig) < 6 + rlen):
-            return False
-        if rlen < 1 or rlen > 33:
-            return False
-        if sig[4] >= 0x80:
-            return False
-        if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
-            return False
-        r = int.from_bytes(sig[4:4+rlen], 'big')
-        if (sig[4+rlen] != 0x02):
-            return False
-        slen = sig[5+rlen]
-        if slen < 1 or slen > 33:
-            return False
-        if (len(sig) != 6 + rlen + slen):
-            return False
-        if sig[6+rlen] >= 0x80:
-            return False
-        if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
-            return False
-        s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
-
-        # Verify that r and s are within the group order
-        if r < 1 or s < 1 or r >= SECP256K1_ORDER or s >= SECP256K1_ORDER:
-            return False
-        if low_s and s >= SECP256K1_ORDER_HALF:
+        rs = _parse_ecdsa_signature(sig, low_s)
+        if rs is None:
             return False
+        r, s = rs
         z = int.from_bytes(msg, 'big')
 
         # Run verifier algorithm on r, s
@@ -393,6 +529,16 @@ class ECPubKey():
             return False
         return True
 
+    @staticmethod
+    def sum_many(points):
+        """Add a non-empty list of ECPubKey points. Much faster than sum() for many points."""
+        assert points and all(point.valid for point in points)
+        ret = ECPubKey()
+        ret.p = SECP256K1.sum_many([point.p for point in points])
+        ret.valid = True
+        ret.compressed = points[0].compressed
+        return ret
+
     def __add__(self, other):
         """Adds two ECPubKey points."""
         assert isinstance(other, ECPubKey)
@@ -604,17 +750,10 @@ class ECKey():
         z = int.from_bytes(msg, 'big')
         # Note: no RFC6979, but a simple random nonce (some tests rely on distinct transactions for the same operation)
         k = random.randrange(1, SECP256K1_ORDER)
-        R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, k)]))
+        R = SECP256K1.affine(SECP256K1.mul_fixed_base(secp256k1_g_table(), k))
         r = R[0] % SECP256K1_ORDER
         s = (modinv(k, SECP256K1_ORDER) * (z + self.secret * r)) % SECP256K1_ORDER
-        if low_s and s > SECP256K1_ORDER_HALF:
-            s = SECP256K1_ORDER - s
-        # Represent in DER format. The byte representations of r and s have
-        # length rounded up (255 bits becomes 32 bytes and 256 bits becomes 33
-        # bytes).
-        rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
-        sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
-        return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
+        return _ecdsa_der(r, s, low_s)
 
     def sign_schnorr(self, msg, aux=None):
         """Create a Schnorr signature (see BIP340)."""
@@ -646,6 +785,56 @@ class ECKey():
         ret.set(tweaked.to_bytes(32, 'big'), self.compressed)
         return ret
 
+def _ecdsa_der(r, s, low_s=True):
+    if low_s and s > SECP256K1_ORDER_HALF:
+        s = SECP256K1_ORDER - s
+    # Represent in DER format. The byte representations of r and s have
+    # length rounded up (255 bits becomes 32 bytes and 256 bits becomes 33
+    # bytes).
+    rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
+    sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
+    return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
+
+def sign_ecdsa_many(items, low_s=True):
+    """Create DER-encoded ECDSA signatures for a list of (ECKey, msg) pairs.
+
+    Equivalent to calling ECKey.sign_ecdsa() on each pair, but the nonce
+    points use the fixed-base table for G and are normalised together, and
+    the nonces are inverted together, with one modular inversion each."""
+    items = list(items)
+    table = secp256k1_g_table()
+    ks = [random.randrange(1, SECP256K1_ORDER) for _ in items]
+    Rs = SECP256K1.affine_many([SECP256K1.mul_fixed_base(table, k) for k in ks])
+    sigs = []
+    for (key, msg), R, k_inv in zip(items, Rs, modinv_many(ks, SECP256K1_ORDER)):
+        assert key.valid
+        r = R[0] % SECP256K1_ORDER
+        s = (k_inv * (int.from_bytes(msg, 'big') + key.secret * r)) % SECP256K1_ORDER
+        sigs.append(_ecdsa_der(r, s, low_s))
+    return sigs
+
+def verify_ecdsa_many(items, low_s=True):
+    """Verify a list of (ECPubKey, sig, msg) tuples. Returns a list of bools.
+
+    Equivalent to calling ECPubKey.verify_ecdsa() on each tuple, but all s
+    values are inverted with one modular inversion, and u1*G uses the
+    fixed-base table for G. R is compared to r in Jacobian coordinates
+    (X == r*Z^2), so no normalisation is needed."""
+    items = list(items)
+    parsed = [_parse_ecdsa_signature(sig, low_s) for _, sig, _ in items]
+    valid = [i for i, rs in enumerate(parsed) if rs is not None]
+    table = secp256k1_g_table()
+    ret = [False] * len(items)
+    for i, w in zip(valid, modinv_many([parsed[i][1] for i in valid], SECP256K1_ORDER)):
+        pubkey, _, msg = items[i]
+        assert pubkey.valid
+        r = parsed[i][0]
+        u1 = int.from_bytes(msg, 'big') * w % SECP256K1_ORDER
+        u2 = r * w % SECP256K1_ORDER
+        R = SECP256K1.add(SECP256K1.mul_fixed_base(table, u1), SECP256K1.mul([(pubkey.p, u2)]))
+        ret[i] = R[2] != 0 and (r * R[2] * R[2]) % SECP256K1_FIELD_SIZE == R[0]
+    return ret
+
 def generate_key_pair(secret=None, compressed=True):
     """Convenience function to generate a private-public key pair."""
     d = ECKey()
@@ -11,38 +11,226 @@ See https://eprint.iacr.org/2018/068.pdf for the MuSig signature scheme implemen
 """
 
 import hashlib
+import random
+import unittest
 
 from .key import (
+    ECPubKey,
+    generate_key_pair,
+    generate_schnorr_nonce,
     SECP256K1,
+    SECP256K1_G,
     SECP256K1_ORDER,
     TaggedHash,
 )
 
+# Aggregates of the most recently used key sets, keyed by the sorted full
+# (not x-only) key serializations, as the aggregate depends on the keys' Y:
+# (coefficients by x-only key bytes, aggregate point).
+_musig_key_cache = {}
+MUSIG_KEY_CACHE_SIZE = 1024
+
+class MuSigSession:
+    """MuSig key aggregation and signing for one set of signers.
+
+    The coefficients of all keys are hashed once, and the aggregate key is
+    computed with a single multi-scalar multiplication. Both are cached per
+    sorted key set, so sessions for the same signers are cheap."""
+
+    def __init__(self, pubkey_list):
+        self.pubkeys = list(pubkey_list)
+        key_bytes = [key.get_bytes() for key in self.pubkeys]
+        sorted_keys = tuple(sorted(key_bytes))
+        cache_key = tuple(sorted(key.get_bytes(False) for key in self.pubkeys))
+        cached = _musig_key_cache.pop(cache_key, None)
+        if cached is None:
+            Lh = hashlib.sha256(b''.join(sorted_keys)).digest()
+            coefficients = {}
+            for data in sorted_keys:
+                coefficients[data] = int.from_bytes(hashlib.sha256(Lh + data).digest(), 'big')
+            terms = [(key.p, coefficients[data]) for key, data in zip(self.pubkeys, key_bytes)]
+            cached = (coefficients, SECP256K1.affine(SECP256K1.mul(terms)))
+            if len(_musig_key_cache) >= MUSIG_KEY_CACHE_SIZE:
+                del _musig_key_cache[next(iter(_musig_key_cache))]
+        # Re-insert to keep the most recently used key sets at the end.
+        _musig_key_cache[cache_key] = cached
+        self.coefficients, point = cached
+        # If the aggregate key has odd Y, signers negate their private keys
+        # to sign for its even Y negation (bip-0340).
+        self.odd_y = point is not None and point[1] & 1 == 1
+        self.aggregate_key = ECPubKey()
+        self.aggregate_key.p = point
+        self.aggregate_key.valid = point is not None
+        self.aggregate_key.compressed = self.pubkeys[0].compressed
+
+    @property
+    def musig_c(self):
+        """The coefficients as returned by generate_musig_key(): a dict of ECPubKey to 32 bytes."""
+        return dict((key, self.coefficient(key).to_bytes(32, 'big')) for key in self.pubkeys)
+
+    def coefficient(self, pubkey):
+        return self.coefficients[pubkey.get_bytes()]
+
+    def aggregate_nonces(self, nonce_point_list):
+        """See aggregate_schnorr_nonces()."""
+        return aggregate_schnorr_nonces(nonce_point_list)
+
+    def sign(self, priv_key, k_key, R_musig, msg):
+        """Construct the partial signature of the signer with private key `priv_key`.
+
+        The key is multiplied by its MuSig coefficient here. If odd_y is set,
+        `priv_key` must already be negated."""
+        tweaked = priv_key.mul(self.coefficient(priv_key.get_pubkey()).to_bytes(32, 'big'))
+        return sign_musig(tweaked, k_key, R_musig, self.aggregate_key, msg)
+
+    def verify_partial(self, s, pubkey, nonce_point, R_musig, msg, negated=False):
+        """Check a partial signature: s*G == R_i + e*a_i*P_i.
+
+        pubkey and nonce_point are the signer's P_i and R_i. `negated` is
+        returned by aggregate_nonces(), in which case the signers negated
+        their nonces. If odd_y is set, the signers negated their private
+        keys, so -P_i is used."""
+        e = musig_digest(R_musig, self.aggregate_key, msg)
+        return self._check_partials([(s, pubkey, nonce_point, 1)], e, negated)
+
+    def verify_partials(self, partials, R_musig, msg, negated=False):
+        """Batch verify partial signatures and find the invalid ones.
+
+        partials: a list of (s, pubkey, nonce_point) tuples
+
+        The checks are combined with random 128-bit weights into one
+        multi-scalar multiplication. If it fails, the list is bisected to
+        find the faulty signers. Returns the indices of the invalid partial
+        signatures, so an empty list if all are valid."""
+        e = musig_digest(R_musig, self.aggregate_key, msg)
+        weighted = [(s, pubkey, nonce_point, random.randrange(1, 2**128)) for s, pubkey, nonce_point in partials]
+        invalid = []
+        stack = [(0, len(weighted))]
+        while stack:
+            start, end = stack.pop()
+            if start == end or self._check_partials(weighted[start:end], e, negated):
+                continue
+            if end - start == 1:
+                invalid.append(start)
+                continue
+            mid = (start + end) // 2
+            stack.append((mid, end))
+            stack.append((start, mid))
+        return invalid
+
+    def _check_partials(self, weighted, e, negated):
+        """Check sum(w_i*(s_i*G - R_i -/+ e*a_i*P_i)) == infinity for (s_i, P_i, R_i, w_i) tuples."""
+        s_sum = 0
+        terms = []
+        for s, pubkey, nonce_point, weight in weighted:
+            if not 0 <= s < SECP256K1_ORDER:
+                return False
+            R_i = nonce_point.p if negated else SECP256K1.negate(nonce_point.p)
+            s_sum += weight * s
+            terms.append((R_i, weight))
+            factor = weight * e * self.coefficient(pubkey)
+            terms.append((pubkey.p, factor % SECP256K1_ORDER if self.odd_y else -factor % SECP256K1_ORDER))
+        terms.append((SECP256K1_G, s_sum % SECP256K1_ORDER))
+        return SECP256K1.mul(terms)[2] == 0
+
+    def aggregate_signatures(self, s_list, R_musig):
+        return aggregate_musig_signatures(s_list, R_musig)
+
 def generate_musig_key(pubkey_list):
     """Aggregate individually generated public keys.
 
     Returns a MuSig public key as defined in the MuSig paper."""
-    pubkey_list_sorted = sorted([int.from_bytes(key.get_bytes(), 'big') for key in pubkey_list])
-    L = b''
-    for px in pubkey_list_sorted:
-        L += px.to_bytes(32, 'big')
-    Lh = hashlib.sha256(L).digest()
-    musig_c = {}
-    aggregate_key = 0
-    for key in pubkey_list:
-        musig_c[key] = hashlib.sha256(Lh + key.get_bytes()).digest()
-        aggregate_key += key.mul(musig_c[key])
-    return musig_c, aggregate_key
+    session = MuSigSession(pubkey_list)
+    return session.musig_c, session.aggregate_key
+
+def revolving_door_combinations(n, k):
+    """Enumerate the k-element subsets of range(n) as bitmasks, in revolving door order.
+
+    Consecutive subsets differ by exactly one element leaving and one
+    element entering the set."""
+    assert 0 <= k <= n
+    # R(n, k) = R(n-1, k) followed by R(n-1, k-1) reversed, with n-1 added.
+    def walk(n, k, reverse):
+        if k == 0:
+            yield 0
+        elif k == n:
+            yield (1 << n) - 1
+        elif not reverse:
+            yield from walk(n - 1, k, False)
+            for mask in walk(n - 1, k - 1, True):
+                yield mask | 1 << (n - 1)
+        else:
+            for mask in walk(n - 1, k - 1, False):
+                yield mask | 1 << (n - 1)
+            yield from walk(n - 1, k, True)
+    return walk(n, k, False)
+
+def generate_musig_subset_keys(pubkey_list, k, weighted=True):
+    """Enumerate the aggregate keys of all k-key subsets of pubkey_list.
+
+    Yields (tuple of ECPubKeys, aggregate ECPubKey), visiting the subsets
+    in revolving door order.
+
+    With `weighted`, each aggregate is the MuSig key of generate_musig_key().
+    The MuSig coefficients depend on the whole key set, so they are hashed
+    again for every subset, but all k terms are added in one multi-scalar
+    multiplication.
+
+    Without `weighted`, the aggregates are plain sums of the keys. This is
+    only secure if the keys are known not to be chosen adversarially (e.g.
+    with proofs of possession). Each subset then costs a single point
+    addition: the differences between all pairs of keys are precomputed, and
+    the running sum is updated by the difference of the keys swapped."""
+    keys = list(pubkey_list)
+    n = len(keys)
+    assert 0 < k <= n
+    if weighted:
+        for mask in revolving_door_combinations(n, k):
+            subset = tuple(keys[i] for i in range(n) if mask >> i & 1)
+            key_bytes = [key.get_bytes() for key in subset]
+            Lh = hashlib.sha256(b''.join(sorted(key_bytes))).digest()
+            terms = [(key.p, int.from_bytes(hashlib.sha256(Lh + data).digest(), 'big')) for key, data in zip(subset, key_bytes)]
+            yield subset, _pubkey_from_point(SECP256K1.mul(terms), subset[0])
+        return
+    # diffs[i][j] = keys[j] - keys[i] in affine form, for i < j.
+    pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+    points = SECP256K1.affine_many([SECP256K1.add(keys[j].p, SECP256K1.negate(keys[i].p)) for i, j in pairs])
+    diffs = [{} for _ in range(n)]
+    for (i, j), point in zip(pairs, points):
+        diffs[i][j] = point
+    prev = None
+    for mask in revolving_door_combinations(n, k):
+        if prev is None:
+            total = (0, 1, 0)
+            for i in range(n):
+                if mask >> i & 1:
+                    total = SECP256K1.add(total, keys[i].p)
+        else:
+            leaving = (prev & ~mask).bit_length() - 1
+            entering = (mask & ~prev).bit_length() - 1
+            diff = diffs[min(leaving, entering)][max(leaving, entering)]
+            # A difference of None means the keys are equal.
+            if diff is not None:
+                total = SECP256K1.add(total, diff if leaving < entering else SECP256K1.negate(diff))
+        prev = mask
+        yield tuple(keys[i] for i in range(n) if mask >> i & 1), _pubkey_from_point(total, keys[0])
+
+def _pubkey_from_point(p, like):
+    ret = ECPubKey()
+    ret.p = p
+    ret.valid = True
+    ret.compressed = like.compressed
+    return ret
 
 def aggregate_schnorr_nonces(nonce_point_list):
     """Construct aggregated musig nonce from individually generated nonces."""
-    R_agg = sum(nonce_point_list)
+    R_agg = ECPubKey.sum_many(list(nonce_point_list))
     R_agg_affine = SECP256K1.affine(R_agg.p)
     negated = False
+    R_agg.p = R_agg_affine
     if R_agg_affine[1] % 2 != 0:
         negated = True
-        R_agg_negated = SECP256K1.mul([(R_agg.p, SECP256K1_ORDER - 1)])
-        R_agg.p = R_agg_negated
+        R_agg.p = SECP256K1.negate(R_agg_affine)
     return R_agg, negated
 
 def sign_musig(priv_key, k_key, R_musig, P_musig, msg):
@@ -65,3 +253,31 @@ def aggregate_musig_signatures(s_list, R_musig):
     assert s_list is not None and all(isinstance(s, int) for s in s_list)
     s_agg = sum(s_list) % SECP256K1_ORDER
     return R_musig.get_x().to_bytes(32, 'big') + s_agg.to_bytes(32, 'big')
+
+class TestFrameworkMuSig(unittest.TestCase):
+    def test_partial_signatures(self):
+        """Sign with random 3-of-3 key sets until both aggregate key parities were seen."""
+        msg = bytes(range(32))
+        seen = set()
+        while len(seen) < 2:
+            pairs = [generate_key_pair() for _ in range(3)]
+            session = MuSigSession([pubkey for _, pubkey in pairs])
+            seen.add(session.odd_y)
+            if session.odd_y:
+                for priv_key, _ in pairs:
+                    priv_key.negate()
+            nonces = [generate_schnorr_nonce() for _ in range(3)]
+            nonce_points = [k.get_pubkey() for k in nonces]
+            R_musig, negated = session.aggregate_nonces(nonce_points)
+            if negated:
+                for k in nonces:
+                    k.negate()
+            s_list = [session.sign(priv_key, k, R_musig, msg) for (priv_key, _), k in zip(pairs, nonces)]
+            sig = session.aggregate_signatures(s_list, R_musig)
+            self.assertTrue(ECPubKey().set(session.aggregate_key.get_bytes()).verify_schnorr(sig, msg))
+            partials = [(s, pubkey, nonce_point) for s, (_, pubkey), nonce_point in zip(s_list, pairs, nonce_points)]
+            for s, pubkey, nonce_point in partials:
+                self.assertTrue(session.verify_partial(s, pubkey, nonce_point, R_musig, msg, negated))
+            self.assertEqual(session.verify_partials(partials, R_musig, msg, negated), [])
+            partials[1] = ((partials[1][0] + 1) % SECP256K1_ORDER,) + partials[1][1:]
+            self.assertEqual(session.verify_partials(partials, R_musig, msg, negated), [1])
@@ -7,19 +7,30 @@
 This file is modified from python-bitcoinlib.
 """
 
-from .messages import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string, CTxInWitness
-from .key import ECKey, ECPubKey
+from .messages import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string, deser_string, ser_compact_size, deser_compact_size, CTxInWitness
+from .key import ECKey, ECPubKey, SECP256K1, SECP256K1_G, SECP256K1_ORDER, generate_bip340_key_pair, secp256k1_g_table
+from .segwit_addr import encode_segwit_address
 
-import binascii
 import hashlib
+import heapq
+from io import BytesIO
 import itertools
-import queue
+import multiprocessing
+import os
+import random
+import re
 import struct
+import sys
+import unittest
+import weakref
 
 from .bignum import bn2vch
 
 MAX_SCRIPT_ELEMENT_SIZE = 520
 LOCKTIME_THRESHOLD = 500000000
+SEQUENCE_LOCKTIME_DISABLE_FLAG = 1 << 31
+SEQUENCE_LOCKTIME_TYPE_FLAG = 1 << 22
+SEQUENCE_LOCKTIME_MASK = 0x0000ffff
 ANNEX_TAG = 0x50
 
 OPCODE_NAMES = {}
@@ -28,6 +39,15 @@ LEAF_VERSION_TAPSCRIPT = 0xc0
 
 DEFAULT_TAPSCRIPT_VER = 0xc0
 TAPROOT_VER = 0
+TAPROOT_CONTROL_MAX_NODE_COUNT = 128
+
+# Binary TapTree serialization, see TapTree.stream_serialize().
+TAPTREE_SERIALIZATION_VERSION = 1
+TAPTREE_FLAG_KEY = 0x01
+# Stored node hashes spare the reader from hashing the tree, but are only
+# as trustworthy as the data: use TapTree.deserialize(f, verify=True) for
+# data from an untrusted source.
+TAPTREE_FLAG_HASHES = 0x02
 
 def hash160(s):
     return hashlib.new('ripemd160', sha256(s)).digest()
@@ -619,11 +639,59 @@ def IsPayToScriptHash(script):
 def IsPayToTaproot(script):
     return len(script) == 34 and script[0] == OP_1 and script[1] == 32
 
+# scriptPubKey templates, keyed by the first byte of the script so that
+# classification only tries the patterns which can possibly match. Patterns
+# only check the byte layout of the script; no keys are parsed.
+SCRIPT_TEMPLATES = {
+    OP_DUP: [('pubkeyhash', re.compile(rb'\x76\xa9\x14.{20}\x88\xac', re.DOTALL))],
+    OP_HASH160: [('scripthash', re.compile(rb'\xa9\x14.{20}\x87', re.DOTALL))],
+    OP_0: [('witness_v0_keyhash', re.compile(rb'\x00\x14.{20}', re.DOTALL)),
+           ('witness_v0_scripthash', re.compile(rb'\x00\x20.{32}', re.DOTALL))],
+    OP_1: [('witness_v1_taproot', re.compile(rb'\x51\x20.{32}', re.DOTALL))],
+    33: [('pubkey', re.compile(rb'\x21[\x02\x03].{32}\xac', re.DOTALL))],
+    65: [('pubkey', re.compile(rb'\x41\x04.{64}\xac', re.DOTALL))],
+    # <key> OP_CHECKSIG (<key> OP_CHECKSIGADD)+ <k> OP_NUMEQUAL, with k pushed
+    # either as OP_1..OP_16 or as a minimal 1- or 2-byte number.
+    32: [('checksigadd', re.compile(rb'\x20.{32}\xac(?:\x20.{32}\xba)+(?:[\x51-\x60]|\x01.|\x02..)\x9c', re.DOTALL))],
+    OP_RETURN: [('nulldata', re.compile(rb'\x6a.*', re.DOTALL))],
+}
+
+def classify_script(script):
+    """Return the template name of a scriptPubKey, or 'nonstandard'."""
+    if len(script) == 0:
+        return 'nonstandard'
+    for name, pattern in SCRIPT_TEMPLATES.get(script[0], ()):
+        if pattern.fullmatch(script):
+            return name
+    return 'nonstandard'
+
+def classify_many(scripts):
+    """Classify an iterable of scriptPubKeys. Returns a list of template names.
+
+    Identical scripts (eg. repeated outputs to the same address) are only
+    matched once."""
+    seen = {}
+    ret = []
+    for script in scripts:
+        script = bytes(script)
+        name = seen.get(script)
+        if name is None:
+            name = seen[script] = classify_script(script)
+        ret.append(name)
+    return ret
+
+# SHA256 midstates after the 64-byte tag prefix, per tag.
+_tagged_hash_midstates = {}
+
 def tagged_hash(tag, data):
-    ss = sha256(tag.encode('utf-8'))
-    ss += ss
-    ss += data
-    return sha256(ss)
+    midstate = _tagged_hash_midstates.get(tag)
+    if midstate is None:
+        tag_hash = sha256(tag.encode('utf-8'))
+        midstate = hashlib.sha256(tag_hash + tag_hash)
+        _tagged_hash_midstates[tag] = midstate
+    ss = midstate.copy()
+    ss.update(data)
+    return ss.digest()
 
 def GetP2SH(script):
     return CScript([OP_HASH160, hash160(script), OP_EQUAL])
@@ -779,26 +847,161 @@ def GetVersionTaggedPubKey(pubkey, version, tweaked_pubkey):
     parity_bit = tweaked_pubkey.get_y()%2
     return bytes([parity_bit & 0x01 | version]) + data
 
+def tapleaf_hash(version, script):
+    return tagged_hash("TapLeaf", bytes([version & 0xfe]) + ser_string(script))
+
+def tapbranch_hash(h_a, h_b):
+    if h_b < h_a:
+        h_a, h_b = h_b, h_a
+    return tagged_hash("TapBranch", h_a + h_b)
+
+def taproot_stream_root(leaves, count, index=None):
+    """Compute the merkle root of `count` TapLeafs read one at a time from the iterable `leaves`.
+
+    The tree has the shape taproot_tree_helper() gives a list of `count`
+    scripts, but only the O(log n) pending subtree hashes are kept in memory,
+    so leaves can come from a generator such as TapLeaf.iter_threshold_csa().
+
+    Returns: (root hash, merkle path of the leaf at position `index` or None)"""
+    assert count > 0
+    leaves = iter(leaves)
+
+    def subtree(start, n):
+        if n == 1:
+            leaf = next(leaves, None)
+            if leaf is None:
+                raise Exception('Fewer than %d leaves provided.' % count)
+            return leaf.tagged_hash(), ([] if start == index else None)
+        h_l, path_l = subtree(start, n // 2)
+        h_r, path_r = subtree(start + n // 2, n - n // 2)
+        if path_l is not None:
+            path_l.append(h_r)
+        elif path_r is not None:
+            path_l = path_r
+            path_l.append(h_l)
+        return tapbranch_hash(h_l, h_r), path_l
+
+    h, path = subtree(0, count)
+    return h, (b''.join(path) if path is not None else None)
+
 def taproot_tree_helper(scripts):
+    """Hash a (nested) list of scripts into a balanced tree.
+
+    Returns ([(version, script, merkle path), ...], root hash). The tree is
+    walked with an explicit stack and each merkle path is joined once, so
+    the cost is linear in the size of the output and deep trees cannot hit
+    the recursion limit. Trees deeper than TAPROOT_CONTROL_MAX_NODE_COUNT
+    are rejected."""
+    if len(scripts) == 0:
+        raise Exception('Cannot construct a tree without scripts.')
+    # Nodes are numbered parents first, so children come after their parent.
+    parents = []
+    hashes = []
+    children = []
+    leaves = []
+    stack = [(scripts, -1, 0)]
+    while stack:
+        scripts, parent, depth = stack.pop()
+        if depth > TAPROOT_CONTROL_MAX_NODE_COUNT:
+            raise Exception('Taproot tree exceeds maximum depth of %d.' % TAPROOT_CONTROL_MAX_NODE_COUNT)
+        idx = len(parents)
+        parents.append(parent)
+        if parent >= 0:
+            children[parent].append(idx)
+        halves = _split_scripts(scripts)
+        if halves is None:
+            while isinstance(scripts, list):
+                scripts = scripts[0]
+            version = DEFAULT_TAPSCRIPT_VER
+            script = scripts
+            if isinstance(script, tuple):
+                version, script = script
+            assert isinstance(script, bytes)
+            hashes.append(tapleaf_hash(version, script))
+            children.append(None)
+            leaves.append((idx, version, script))
+        else:
+            hashes.append(None)
+            children.append([])
+            stack.append((halves[1], idx, depth + 1))
+            stack.append((halves[0], idx, depth + 1))
+
+    # Hash branches bottom-up, remembering each node's sibling.
+    siblings = [0] * len(parents)
+    for idx in range(len(parents) - 1, -1, -1):
+        if hashes[idx] is None:
+            left, right = children[idx]
+            siblings[left], siblings[right] = right, left
+            hashes[idx] = tapbranch_hash(hashes[left], hashes[right])
+
+    ret = []
+    for idx, version, script in leaves:
+        path = []
+        while idx != 0:
+            path.append(hashes[siblings[idx]])
+            idx = parents[idx]
+        ret.append((version, script, b''.join(path)))
+    return (ret, hashes[0])
+
+def _split_scripts(scripts):
+    """Split a list of scripts the way taproot_tree_helper() does. Returns None for a single leaf."""
+    while len(scripts) == 1 and isinstance(scripts[0], list):
+        scripts = scripts[0]
     if len(scripts) == 1:
-        script = scripts[0]
-        if isinstance(script, list):
-            return taproot_tree_helper(script)
-        version = DEFAULT_TAPSCRIPT_VER
-        if isinstance(script, tuple):
-            version, script = script
-        assert isinstance(script, bytes)
-        h = tagged_hash("TapLeaf", bytes([version & 0xfe]) + ser_string(script))
-        return ([(version, script, bytes())], h)
+        return None
     split_pos = len(scripts) // 2
-    left, left_h = taproot_tree_helper(scripts[0:split_pos])
-    right, right_h = taproot_tree_helper(scripts[split_pos:])
-    left = [(version, script, control + right_h) for version, script, control in left]
-    right = [(version, script, control + left_h) for version, script, control in right]
-    if right_h < left_h:
-        right_h, left_h = left_h, right_h
-    h = tagged_hash("TapBranch", left_h + right_h)
-    return (left + right, h)
+    return scripts[0:split_pos], scripts[split_pos:]
+
+def taproot_tree_helper_parallel(scripts, processes=None):
+    """Multi-process version of taproot_tree_helper() with identical output.
+
+    The top levels of the tree are split until there are a few subtrees per
+    process. The subtrees are hashed by taproot_tree_helper() in worker
+    processes and the results are merged into the root here."""
+    processes = processes or os.cpu_count() or 1
+    jobs = []
+
+    def split(scripts, depth):
+        halves = _split_scripts(scripts)
+        if halves is None or (1 << depth) >= 4 * processes:
+            jobs.append(scripts)
+            return len(jobs) - 1
+        return (split(halves[0], depth + 1), split(halves[1], depth + 1))
+
+    shape = split(scripts, 0)
+    if len(jobs) == 1 or processes == 1:
+        return taproot_tree_helper(scripts)
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(taproot_tree_helper, jobs)
+
+    # Hash the top levels, then extend each subtree's control blocks with
+    # the sibling hashes above it.
+    hashes = {}
+
+    def merge(shape):
+        if isinstance(shape, int):
+            return results[shape][1]
+        h = tapbranch_hash(merge(shape[0]), merge(shape[1]))
+        hashes[id(shape)] = h
+        return h
+
+    def subtree_hash(shape):
+        return results[shape][1] if isinstance(shape, int) else hashes[id(shape)]
+
+    ret = []
+
+    def collect(shape, suffix):
+        if isinstance(shape, int):
+            ret.extend((version, script, control + suffix) for version, script, control in results[shape][0])
+            return
+        collect(shape[0], subtree_hash(shape[1]) + suffix)
+        collect(shape[1], subtree_hash(shape[0]) + suffix)
+
+    h = merge(shape)
+    collect(shape, bytes())
+    if any(len(control) > 32 * TAPROOT_CONTROL_MAX_NODE_COUNT for _, _, control in ret):
+        raise Exception('Taproot tree exceeds maximum depth of %d.' % TAPROOT_CONTROL_MAX_NODE_COUNT)
+    return (ret, h)
 
 def taproot_construct(pubkey, scripts=[]):
     """Construct a tree of taproot spending conditions
@@ -811,22 +1014,146 @@ def taproot_construct(pubkey, scripts=[]):
 
     Returns: script (sPK or redeemScript), tweak, {script:control, ...}
     """
+    if len(scripts) == 0:
+        # Without scripts the key is tweaked with its own hash only (see bip-0341).
+        ret, h = [], bytes()
+    else:
+        ret, h = taproot_tree_helper(scripts)
     tweak = tagged_hash("TapTweak", pubkey.get_bytes() + h)
     tweaked = pubkey.tweak_add(tweak)
-    if len(scripts) == 0:
-        return (CScript([OP_1, GetVersionTaggedPubKey(pubkey, TAPROOT_VER, tweaked)]), bytes([0 for i in range(32)]), {})
-
-    ret, h = taproot_tree_helper(scripts)
     control_map = dict((script, GetVersionTaggedPubKey(pubkey, version, tweaked) + control) for version, script, control in ret)
-    return (CScript([OP_1, GetVersionTaggedPubKey(tweaked, TAPROOT_VER, tweaked)]), tweak, control_map)
+    return (CScript([OP_1, tweaked.get_bytes()]), tweak, control_map)
+
+def taproot_construct_many(pubkeys, scripts=[], main=False, batch_size=1024):
+    """Construct the taproot outputs of many internal keys sharing one tree of spending conditions
+
+    pubkeys: an iterable of ECPubKey objects for the root pubkeys
+    scripts: as for taproot_construct()
+    main: whether to encode mainnet (bc) or regtest (bcrt) addresses
+
+    The script tree is hashed once. Tweaks are multiplied with a
+    precomputed table for G, and each batch of batch_size output keys is
+    converted to affine form with a single modular inversion. Keys are
+    consumed and results produced lazily, so any number of outputs can be
+    streamed.
+
+    Yields: (script, tweak, {script:control, ...}, address) for each pubkey, in order.
+    """
+    if len(scripts) == 0:
+        ret, h = [], bytes()
+    else:
+        ret, h = taproot_tree_helper(scripts)
+    table = secp256k1_g_table()
+    hrp = "bc" if main else "bcrt"
+    pubkeys = iter(pubkeys)
+    while True:
+        batch = list(itertools.islice(pubkeys, batch_size))
+        if not batch:
+            return
+        tweaks = []
+        points = []
+        for pubkey in batch:
+            assert pubkey.is_valid
+            tweak = tagged_hash("TapTweak", pubkey.get_bytes() + h)
+            t = int.from_bytes(tweak, 'big')
+            if t >= SECP256K1_ORDER:
+                raise Exception('Tweak is not a valid scalar.')
+            tweaks.append(tweak)
+            points.append(SECP256K1.add(SECP256K1.mul_fixed_base(table, t), pubkey.p))
+        for pubkey, tweak, point in zip(batch, tweaks, SECP256K1.affine_many(points)):
+            if point is None:
+                raise Exception('Tweaked key is the point at infinity.')
+            program = point[0].to_bytes(32, 'big')
+            internal = pubkey.get_bytes()
+            parity = point[1] & 1
+            control_map = dict((script, bytes([version | parity]) + internal + control) for version, script, control in ret)
+            address = encode_segwit_address(hrp, 1, program)
+            yield (CScript([OP_1, program]), tweak, control_map, address)
+
+def _control_block_tweak(script, control, branch_cache=None):
+    """Return the (internal key, tweak) committed to by a control block for `script`, or None if malformed.
+
+    `branch_cache` can be a dict shared between calls to avoid rehashing
+    merkle path steps that several control blocks have in common."""
+    if len(control) < 33 or (len(control) - 33) % 32 or (len(control) - 33) // 32 > TAPROOT_CONTROL_MAX_NODE_COUNT:
+        return None
+    internal = ECPubKey().set(control[1:33])
+    if not internal.is_valid:
+        return None
+    h = tapleaf_hash(control[0] & 0xfe, script)
+    for pos in range(33, len(control), 32):
+        sibling = control[pos:pos + 32]
+        if branch_cache is None:
+            h = tapbranch_hash(h, sibling)
+        else:
+            step = (h, sibling) if h < sibling else (sibling, h)
+            branch_h = branch_cache.get(step)
+            if branch_h is None:
+                branch_h = branch_cache[step] = tapbranch_hash(*step)
+            h = branch_h
+    tweak = int.from_bytes(tagged_hash("TapTweak", control[1:33] + h), 'big')
+    if tweak >= SECP256K1_ORDER:
+        return None
+    return internal, tweak
+
+def verify_taproot_commitment(output_key, script, control):
+    """Check that the taproot output key commits to spending `script` with control block `control`.
+
+    output_key: the 32-byte output key from the scriptPubKey, or an ECPubKey."""
+    if isinstance(output_key, ECPubKey):
+        output_key = output_key.get_bytes()
+    ret = _control_block_tweak(script, control)
+    if ret is None:
+        return False
+    internal, tweak = ret
+    tweaked = internal.tweak_add(tweak)
+    if tweaked is None:
+        return False
+    return tweaked.get_bytes() == output_key and tweaked.get_y() & 1 == control[0] & 1
+
+def verify_taproot_commitments(commitments):
+    """Batch version of verify_taproot_commitment().
+
+    commitments: an iterable of (output_key, script, control) tuples.
+
+    Merkle path steps shared between control blocks are hashed once. The
+    checks Q_i == P_i + t_i*G are combined with random 128-bit weights a_i
+    into a single multi-scalar multiplication
+    sum(a_i*(Q_i - P_i)) - (sum(a_i*t_i))*G == infinity.
+    Returns True only if every commitment is valid."""
+    branch_cache = {}
+    points = []
+    tweak_sum = 0
+    for output_key, script, control in commitments:
+        if isinstance(output_key, ECPubKey):
+            output_key = output_key.get_bytes()
+        ret = _control_block_tweak(script, control, branch_cache)
+        if ret is None or len(output_key) != 32:
+            return False
+        internal, tweak = ret
+        output_point = SECP256K1.lift_x(int.from_bytes(output_key, 'big'))
+        if output_point is None:
+            return False
+        if output_point[1] & 1 != control[0] & 1:
+            output_point = SECP256K1.negate(output_point)
+        weight = random.randrange(1, 2**128)
+        points.append((SECP256K1.add(output_point, SECP256K1.negate(internal.p)), weight))
+        tweak_sum = (tweak_sum + weight * tweak) % SECP256K1_ORDER
+    if not points:
+        return True
+    points.append((SECP256K1_G, (SECP256K1_ORDER - tweak_sum) % SECP256K1_ORDER))
+    return SECP256K1.mul(points)[2] == 0
 
 def is_op_success(o):
     return o == 0x50 or o == 0x62 or o == 0x89 or o == 0x8a or o == 0x8d or o == 0x8e or (o >= 0x7e and o <= 0x81) or (o >= 0x83 and o <= 0x86) or (o >= 0x95 and o <= 0x99) or (o >= 0xbb and o <= 0xfe)
 
 def IsPayToPubkey(script):
+    # Check the cheap shape conditions before decompressing the key.
+    if len(script) != 35 or script[0] != 33 or script[-1] != OP_CHECKSIG:
+        return False
     pk = ECPubKey()
     pk.set(script[1:34])
-    return pk.is_valid and len(script) == 35 and script[-1] == OP_CHECKSIG
+    return pk.is_valid
 
 def IsCheckSigAdd(script):
     if script[-1] == OP_EQUAL and isinstance(script[-2], int) and script[-3] == OP_CHECKSIGADD:
@@ -834,26 +1161,105 @@ def IsCheckSigAdd(script):
     else:
         return False
 
-def ParseDesc(desc, tag, op, cl):
-    op_tag = tag+op
-    assert(desc[:len(op_tag)] == op_tag)
-    desc = desc[len(op_tag):-1]
-    depth = 0
-    for t in desc:
-        if t == op:
-            depth += 1
-        if t == cl:
-            depth -= 1
-    if depth == 0:
-        return desc
-    else:
-        # Malformed descriptor.
-        raise Exception
+class DescriptorParseError(Exception):
+    """Malformed tp() or ts() descriptor"""
+    def __init__(self, msg, pos):
+        self.pos = pos
+        super(DescriptorParseError, self).__init__('%s at position %d' % (msg, pos))
+
+_DESC_TOKEN_RE = re.compile(r'\s*(?:([0-9A-Za-z_]+)|([()\[\],@:])|(\S))')
+
+class DescriptorTokenizer:
+    """Single-pass tokenizer for tp() and ts() descriptors, spending policies and miniscript.
+
+    Tokens are words (names, hex and decimal arguments) and the punctuation
+    characters ( ) [ ] @ : and ','. Whitespace between tokens is ignored. Each
+    token's position in the string is kept for error messages."""
+    def __init__(self, string):
+        self.string = string
+        self._matches = _DESC_TOKEN_RE.finditer(string)
+        self._advance()
+
+    def _advance(self):
+        m = next(self._matches, None)
+        if m is None:
+            self.token, self.is_word, self.pos = None, False, len(self.string)
+        elif m.group(3) is not None:
+            raise DescriptorParseError("Unexpected character '%s'" % m.group(3), m.start(3))
+        elif m.group(1) is not None:
+            self.token, self.is_word, self.pos = m.group(1), True, m.start(1)
+        else:
+            self.token, self.is_word, self.pos = m.group(2), False, m.start(2)
+
+    def _describe(self):
+        return "'%s'" % self.token if self.token is not None else 'end of input'
+
+    def accept(self, token):
+        """Consume `token` if it is next. Returns whether it was."""
+        if self.token == token and self.token is not None:
+            self._advance()
+            return True
+        return False
+
+    def expect(self, token):
+        if not self.accept(token):
+            raise DescriptorParseError("Expected '%s', got %s" % (token, self._describe()), self.pos)
+
+    def word(self, what):
+        """Consume a word token and return (word, position)."""
+        if not self.is_word:
+            raise DescriptorParseError("Expected %s, got %s" % (what, self._describe()), self.pos)
+        ret = (self.token, self.pos)
+        self._advance()
+        return ret
+
+    def end(self):
+        if self.token is not None:
+            raise DescriptorParseError("Unexpected %s" % self._describe(), self.pos)
+
+def _desc_key(arg):
+    data, pos = _desc_bytes(arg)
+    pk = ECPubKey()
+    pk.set(data)
+    if len(data) != 32 or not pk.is_valid:
+        raise DescriptorParseError('Invalid key', pos)
+    return pk
+
+def _desc_bytes(arg):
+    value, pos = arg
+    try:
+        return bytes.fromhex(value), pos
+    except ValueError:
+        raise DescriptorParseError('Invalid hex', pos)
+
+def _desc_int(arg):
+    value, pos = arg
+    if not value.isdigit():
+        raise DescriptorParseError('Invalid number', pos)
+    return int(value)
+
+def _desc_hash160(arg):
+    data, pos = _desc_bytes(arg)
+    if len(data) != 20:
+        raise DescriptorParseError('Expected a 20-byte hash', pos)
+    return data
+
+def _desc_raw(leaf, args):
+    leaf.script = CScript(_desc_bytes(args[0])[0])
+    leaf.desc = 'ts(raw(' + leaf.script.hex() + '))'
+    return leaf
 
 class TapLeaf:
     def __init__(self, desc=None, version=DEFAULT_TAPSCRIPT_VER):
-        self.version = version
-        self.script = None
+        # Cached tagged hash, reset whenever the version or script changes.
+        self._hash = None
+        # Tapbranches which have this leaf as a child. Weak, so that the
+        # leaf does not keep the trees built from it alive.
+        self._parents = weakref.WeakSet()
+        # Set for nodes owned by a TapNodeStore, which are shared between trees.
+        self._interned = False
+        self._version = version
+        self._script = None
         self.miniscript = None
         self.sat = None
         if desc:
@@ -891,7 +1297,9 @@ class TapLeaf:
         return self
 
     def construct_csa(self, k, pkv):
-        keys_data = [key.get_bytes() for key in pkv]
+        return self._construct_csa(k, [key.get_bytes() for key in pkv])
+
+    def _construct_csa(self, k, keys_data):
         thresh_csa_node = miniscript.thresh_csa(k, *keys_data)
         self._set_miniscript(thresh_csa_node)
         keys_string = [data.hex() for data in keys_data]
@@ -930,10 +1338,24 @@ class TapLeaf:
         self.desc = TapLeaf._desc_serializer('csa_hashlock_delay', str(k), *keys_string, data.hex(),str(delay))
         return self
 
+    def construct_miniscript(self, node):
+        """Construct the leaf from a miniscript node, e.g. one from PolicyCompiler."""
+        self._set_miniscript(node)
+        self.desc = 'ts(raw(' + self.script.hex() + '))'
+        return self
+
+    def construct_policy(self, policy):
+        """Construct the leaf from a spending policy without alternatives (see parse_policy())."""
+        compiled = compile_policy(policy)
+        if len(compiled) != 1:
+            raise Exception('Policy has %d spending paths, use TapTree.policy_constructor().' % len(compiled))
+        return self.construct_miniscript(compiled[0][1])
+
     def _set_miniscript(self, miniscript):
         self.miniscript = miniscript
         self.script = CScript(self.miniscript.script)
-        self.sat = self.miniscript.sat_xy
+        # Copied, as the node's sat_xy is memoised.
+        self.sat = list(self.miniscript.sat_xy)
 
     @staticmethod
     def _desc_serializer(tag, *args):
@@ -943,109 +1365,75 @@ class TapLeaf:
         desc += args[-1] + '))'
         return desc
 
-    def from_desc(self,string):
-        string = ''.join(string.split())
-        tss = ParseDesc(string, 'ts', '(',')')
-
-        if tss[:3] == 'pk(':
-            expr_s = ParseDesc(tss, 'pk' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            self.construct_pk(pk)
-
-        elif tss[:8] == 'pk_delay(':
-            expr_s = ParseDesc(tss, 'pk_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            self.construct_pk_delay(pk, int(args[1]))
-
-        elif tss[:7] == 'pk_hashlock(':
-            expr_s = ParseDesc(tss, 'pk_hashlock' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            data = bytes.fromhex(args[1])
-            self.construct_pk_hashlock(pk, data)
-
-        elif tss[:12] == 'pk_hashlock_delay(':
-            expr_s = ParseDesc(tss, 'pk_hashlock_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            data = bytes.fromhex(args[1])
-            self.construct_pk_hashlock_delay(pk, data, int(args[2]))
-
-        elif tss[:4] == 'csa(':
-            expr_s = ParseDesc(tss, 'csa' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            self.construct_csa(k, pkv)
-
-        elif tss[:9] == 'csa_delay(':
-            expr_s = ParseDesc(tss, 'csa_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:-1]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            delay = int(args[-1])
-            self.construct_csa_delay(k, pkv, delay)
-
-        elif tss[:8] == 'csa_hashlock(':
-            expr_s = ParseDesc(tss, 'csa_hashlock' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:-1]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            data = bytes.fromhex(args[-1])
-            self.construct_csa_hashlock(k, pkv, data)
-
-        elif tss[:13] == 'csa_hashlock_delay(':
-            expr_s = ParseDesc(tss, 'csa_hashlock_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:-2]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            data = bytes.fromhex(args[-2])
-            delay = int(args[-1])
-            self.construct_csa_hashlock_delay(k, pkv, data, delay)
-
-        elif tss[:4] =='raw(':
-            self.script = CScript(binascii.unhexlify(tss[4:-1]))
+    def from_desc(self, string):
+        tokens = DescriptorTokenizer(string)
+        self._parse_desc(tokens)
+        tokens.end()
+        return self
+
+    def _parse_desc(self, tokens):
+        """Parse a ts(fragment(args...)) descriptor from a DescriptorTokenizer."""
+        tokens.expect('ts')
+        tokens.expect('(')
+        name, pos = tokens.word('tapscript fragment')
+        if name not in TAPSCRIPT_DESC_FRAGMENTS:
+            raise DescriptorParseError("Unknown tapscript fragment '%s'" % name, pos)
+        min_args, max_args, construct = TAPSCRIPT_DESC_FRAGMENTS[name]
+        tokens.expect('(')
+        args = [tokens.word('argument')]
+        while tokens.accept(','):
+            args.append(tokens.word('argument'))
+        if len(args) < min_args or (max_args is not None and len(args) > max_args):
+            raise DescriptorParseError("Wrong number of arguments for '%s'" % name, pos)
+        tokens.expect(')')
+        tokens.expect(')')
+        construct(self, args)
+        return self
 
-        else:
-            raise Exception('Tapscript descriptor not recognized.')
+    @property
+    def max_sat_size(self):
+        """Worst-case size of the satisfying witness items, or None without miniscript."""
+        return None if self.miniscript is None else self.miniscript.max_sat_size
 
-    @staticmethod
-    def _param_parser(expr_string):
-        args = []
-        idx_ = 0
-        expr_string_ = expr_string
-        for idx, ch in enumerate(expr_string):
-            if ch == ',':
-                args.append(expr_string[idx_:idx])
-                idx_ = idx+1
-                expr_string_ = expr_string[idx_:]
-        args.append(expr_string_)
-        return args
+    @property
+    def max_stack(self):
+        """Maximum stack size while executing a satisfaction, or None without miniscript."""
+        return None if self.miniscript is None else self.miniscript.max_stack
+
+    @property
+    def sig_count(self):
+        """Number of signatures checked by a satisfaction, or None without miniscript."""
+        return None if self.miniscript is None else self.miniscript.sig_count
+
+    @property
+    def version(self):
+        return self._version
+
+    @version.setter
+    def version(self, version):
+        _check_mutable(self)
+        self._version = version
+        self._invalidate()
+
+    @property
+    def script(self):
+        return self._script
+
+    @script.setter
+    def script(self, script):
+        _check_mutable(self)
+        self._script = script
+        self._invalidate()
+
+    def _invalidate(self):
+        """Drop the cached hash of this leaf and of all branches above it."""
+        self._hash = None
+        _invalidate_parents(self)
 
     def tagged_hash(self):
-        return tagged_hash("TapLeaf", bytes([self.version & 0xfe]) + ser_string(self.script))
+        if self._hash is None:
+            self._hash = tapleaf_hash(self.version, self.script)
+        return self._hash
 
     def __lt__(self, other):
         return self.tagged_hash() < other.tagged_hash()
@@ -1055,54 +1443,378 @@ class TapLeaf:
 
     @staticmethod
     def generate_threshold_csa(k, pubkeys):
+        return list(TapLeaf.iter_threshold_csa(k, pubkeys))
+
+    @staticmethod
+    def iter_threshold_csa(k, pubkeys):
+        """Lazily yield a k-of-k csa TapLeaf for each k-subset of `pubkeys`.
+
+        Keys are serialized and sorted once; leaves are yielded in the same
+        order as generate_threshold_csa() returns them. There are
+        math.comb(len(pubkeys), k) leaves, which can be passed as `count` to
+        taproot_stream_root(). The arguments are checked when this is
+        called, not when the first leaf is taken."""
         if k == 1 or len(pubkeys) <= k:
-            raise Exception
-        pubkeys_b = [pubkey.get_bytes() for pubkey in pubkeys]
-        pubkeys_b.sort()
-        pubkey_b_sets = list(itertools.combinations(iter(pubkeys_b), k))
-        tapscripts = []
-        for pubkey_b_set in pubkey_b_sets:
-            pubkey_set = []
-            for pubkey_b in pubkey_b_set:
-                pk = ECPubKey()
-                pk.set(pubkey_b)
-                pubkey_set.append(pk)
-            tapscript = TapLeaf()
-            tapscript.construct_csa(k, pubkey_set)
-            tapscripts.append(tapscript)
-        return tapscripts
+            raise Exception('Threshold k must be above 1 and below the number of keys (%d).' % len(pubkeys))
+        pubkeys_b = sorted(pubkey.get_bytes() for pubkey in pubkeys)
+        return (TapLeaf()._construct_csa(k, list(pubkey_b_set)) for pubkey_b_set in itertools.combinations(pubkeys_b, k))
+
+def _package_merge(weights, max_depth):
+    """Optimal code lengths, each at most max_depth, for ascending `weights` (package-merge)."""
+    n = len(weights)
+    if n == 1:
+        return [0]
+    # Each level lists (weight, leaf index or None for a package) in
+    # ascending weight order. A package at level j pairs two consecutive
+    # items of level j-1, so the first k packages use its first 2k items.
+    leaf_items = [(w, i) for i, w in enumerate(weights)]
+    levels = [leaf_items]
+    for _ in range(max_depth - 1):
+        prev = levels[-1]
+        packages = [(prev[j][0] + prev[j + 1][0], None) for j in range(0, len(prev) - 1, 2)]
+        levels.append(list(heapq.merge(leaf_items, packages, key=lambda item: item[0])))
+    lengths = [0] * n
+    take = 2 * n - 2
+    for level in reversed(levels):
+        packages = 0
+        for _, i in level[:take]:
+            if i is None:
+                packages += 1
+            else:
+                lengths[i] += 1
+        take = 2 * packages
+    return lengths
+
+def _satisfaction_size(leaf, worst_case=False):
+    """Serialized size of the witness stack items which satisfy `leaf`."""
+    if leaf.miniscript is not None:
+        return leaf.miniscript.max_sat_size if worst_case else leaf.miniscript.sat_size
+    if leaf.sat is None:
+        raise Exception('Leaf %s has no miniscript or satisfaction template; pass its satisfaction size explicitly.' % leaf.script.hex())
+    # Leaves without miniscript: estimate from the sat template.
+    size = 0
+    for element in leaf.sat:
+        if isinstance(element, tuple) and element[0] == 'sig':
+            size += 1 + (65 if worst_case else 64)
+        elif isinstance(element, tuple) and element[0] == 'preimage':
+            size += 1 + 32
+        else:
+            size += 1
+    return size
+
+def tapleaf_witness_size(leaf, depth, worst_case=False, sat_size=None):
+    """Serialized witness size in bytes (= weight units) of spending TapLeaf `leaf` at `depth` in a tree.
+
+    Counts the satisfying stack items, the script and the control block,
+    each with its length prefix, plus the stack item count. Signatures are
+    64 bytes (SIGHASH_DEFAULT), or 65 bytes if `worst_case` is set.
+
+    `sat_size` is the size of the satisfying stack items, with their length
+    prefixes. It is required for leaves without miniscript or a sat template,
+    for which the stack item count is assumed to fit in one byte."""
+    control_size = 33 + 32 * depth
+    n_items = len(leaf.sat or []) + 2
+    if sat_size is None:
+        sat_size = _satisfaction_size(leaf, worst_case)
+    return (len(ser_compact_size(n_items)) + sat_size + len(ser_string(leaf.script)) +
+            len(ser_compact_size(control_size)) + control_size)
+
+def rank_taptrees(trees, probabilities=None, sat_sizes=None):
+    """Sort candidate TapTrees by expected script path spend cost, cheapest first.
+
+    See TapTree.spend_cost() for `probabilities` and `sat_sizes`. Returns a
+    list of (expected vbytes, worst-case vbytes, tree) tuples."""
+    ranked = []
+    for idx, tree in enumerate(trees):
+        expected, worst = tree.spend_cost(probabilities, sat_sizes)
+        ranked.append((expected, worst, idx, tree))
+    ranked.sort(key=lambda item: item[:3])
+    return [(expected, worst, tree) for expected, worst, _, tree in ranked]
+
+# Tapscript descriptor fragments: name -> (min #args, max #args or None, constructor).
+TAPSCRIPT_DESC_FRAGMENTS = {
+    'pk': (1, 1, lambda leaf, a: leaf.construct_pk(_desc_key(a[0]))),
+    'pk_delay': (2, 2, lambda leaf, a: leaf.construct_pk_delay(_desc_key(a[0]), _desc_int(a[1]))),
+    'pk_hashlock': (2, 2, lambda leaf, a: leaf.construct_pk_hashlock(_desc_key(a[0]), _desc_hash160(a[1]))),
+    'pk_hashlock_delay': (3, 3, lambda leaf, a: leaf.construct_pk_hashlock_delay(_desc_key(a[0]), _desc_hash160(a[1]), _desc_int(a[2]))),
+    'csa': (3, None, lambda leaf, a: leaf.construct_csa(_desc_int(a[0]), [_desc_key(k) for k in a[1:]])),
+    'csa_delay': (4, None, lambda leaf, a: leaf.construct_csa_delay(_desc_int(a[0]), [_desc_key(k) for k in a[1:-1]], _desc_int(a[-1]))),
+    'csa_hashlock': (4, None, lambda leaf, a: leaf.construct_csa_hashlock(_desc_int(a[0]), [_desc_key(k) for k in a[1:-1]], _desc_hash160(a[-1]))),
+    'csa_hashlock_delay': (5, None, lambda leaf, a: leaf.construct_csa_hashlock_delay(_desc_int(a[0]), [_desc_key(k) for k in a[1:-2]], _desc_hash160(a[-2]), _desc_int(a[-1]))),
+    'raw': (1, 1, _desc_raw),
+}
 
 class TapTree:
     def __init__(self, *, key=None, root=None):
         """Taptree constructor. Takes an optional `key` ECPubKey and `root` Tapbranch."""
         self.key = key if key else ECPubKey()
         self.root = root if root else Tapbranch()
+        # State of the last construct() call, used by replace_leaf().
+        self._constructed = None
+        # (key, root hash, tweak, tweaked key) of the last tweak computed.
+        self._tweak_cache = None
+        # Maps id(node) to its parent in this tree, see _path_to_root().
+        self._parent_index = None
 
     def from_desc(self, desc):
-        desc = ''.join(desc.split())
-        pk = ECPubKey()
-        pk.set(binascii.unhexlify(desc[3:67]))
-        if len(desc)>69 and desc[:3] == 'tp(' and pk.is_valid and desc[67] == ',' and desc[-1] == ')':
-            self.key = pk
-            self._decode_tree(desc[68:-1], parent=self.root)
-        else:
-            raise Exception
+        tokens = DescriptorTokenizer(desc)
+        tokens.expect('tp')
+        tokens.expect('(')
+        key = _desc_key(tokens.word('internal key'))
+        tokens.expect(',')
+        if tokens.token != '[':
+            raise DescriptorParseError("Expected '[', got %s" % tokens._describe(), tokens.pos)
+        root = TapTree._parse_tree(tokens, 0)
+        tokens.expect(')')
+        tokens.end()
+        self.key = key
+        self.root = root
         return self
 
+    @staticmethod
+    def _parse_tree(tokens, depth):
+        """Parse a tree item: either a leaf descriptor or a bracketed pair of items."""
+        if not tokens.accept('['):
+            return TapLeaf()._parse_desc(tokens)
+        if depth >= TAPROOT_CONTROL_MAX_NODE_COUNT:
+            raise DescriptorParseError('Taproot tree exceeds maximum depth of %d' % TAPROOT_CONTROL_MAX_NODE_COUNT, tokens.pos)
+        left = TapTree._parse_tree(tokens, depth + 1)
+        if not tokens.accept(','):
+            tokens.expect(']')
+            return left
+        right = TapTree._parse_tree(tokens, depth + 1)
+        tokens.expect(']')
+        return Tapbranch(left, right)
+
     # Tree construction from list(weight(int), TapScript)
     def huffman_constructor(self, tuple_list):
-        p = queue.PriorityQueue()
-        for weight_tapleaf in tuple_list:
-            p.put(weight_tapleaf)
-        while p.qsize() > 1:
-            l, r = p.get(), p.get()
-            node = Tapbranch(l[1], r[1])
-            p.put((l[0]+r[0], node))
-        self.root = p.get()[1]
+        """Build the tree from an iterable of (weight, TapLeaf) tuples.
+
+        Nodes are ordered by weight, then by tagged hash. Ties on both fall
+        back to insertion order, so nodes themselves are never compared."""
+        seq = itertools.count()
+        heap = [(weight, leaf.tagged_hash(), next(seq), leaf) for weight, leaf in tuple_list]
+        if not heap:
+            raise Exception('Cannot construct a tree without leaves.')
+        heapq.heapify(heap)
+        while len(heap) > 1:
+            l_weight, _, _, l = heapq.heappop(heap)
+            r_weight, _, _, r = heapq.heappop(heap)
+            node = Tapbranch(l, r)
+            heapq.heappush(heap, (l_weight + r_weight, node.tagged_hash(), next(seq), node))
+        self.root = heap[0][3]
+
+    def policy_constructor(self, policy):
+        """Build the tree from a spending policy (see parse_policy()).
+
+        Each alternative spending path of the policy becomes a compiled leaf,
+        which is placed with huffman_constructor() by its probability."""
+        self.huffman_constructor([(p, TapLeaf().construct_miniscript(node)) for p, node in compile_policy(policy)])
+
+    def length_limited_constructor(self, tuple_list, max_depth=TAPROOT_CONTROL_MAX_NODE_COUNT):
+        """Build the tree from (weight, TapLeaf) tuples minimising the expected script path witness size.
+
+        A leaf at depth d costs 32*d control block bytes on top of its script,
+        satisfaction and the fixed part of the control block. Only the depth
+        term depends on the tree shape, so the optimal tree with no leaf deeper
+        than `max_depth` is found with package-merge on the weights.
+
+        Returns the expected witness vbytes of a script path spend, with leaves
+        spent in proportion to their weights, or None if a leaf has neither
+        miniscript nor a sat template to size its satisfaction."""
+        leaves = list(tuple_list)
+        if not leaves:
+            raise Exception('Cannot construct a tree without leaves.')
+        n = len(leaves)
+        max_depth = min(max_depth, n - 1)
+        if n > 1 and n > 1 << max_depth:
+            raise Exception('%d leaves do not fit in a tree of depth %d.' % (n, max_depth))
+        order = sorted(range(n), key=lambda i: (leaves[i][0], leaves[i][1].tagged_hash(), i))
+        lengths = _package_merge([leaves[i][0] for i in order], max_depth)
+
+        # Build the tree bottom-up: the nodes at each depth are that depth's
+        # leaves followed by the branches paired up from the level below.
+        by_depth = [[] for _ in range(max(lengths) + 1)]
+        for i, length in zip(order, lengths):
+            by_depth[length].append(leaves[i][1])
+        level = []
+        for depth in range(len(by_depth) - 1, -1, -1):
+            level = by_depth[depth] + [Tapbranch(level[j], level[j + 1]) for j in range(0, len(level), 2)]
+        assert len(level) == 1
+        self.root = level[0]
+
+        total_weight = sum(weight for weight, _ in leaves)
+        if total_weight == 0:
+            return 0
+        if any(leaf.miniscript is None and leaf.sat is None for _, leaf in leaves):
+            return None
+        cost = sum(leaves[i][0] * tapleaf_witness_size(leaves[i][1], length) for i, length in zip(order, lengths))
+        return cost / total_weight / 4
+
+    def leaf_depths(self):
+        """Iterate over (TapLeaf, depth) pairs, from the leftmost leaf to the rightmost."""
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if isinstance(node, TapLeaf):
+                yield node, depth
+            else:
+                stack.append((node.right, depth + 1))
+                stack.append((node.left, depth + 1))
+
+    def spend_costs(self, worst_case=False, sat_sizes=None):
+        """Return a list of (TapLeaf, witness vbytes) for a script path spend of each leaf.
+
+        sat_sizes: optional dict mapping leaf scripts to the size of their
+        satisfying stack items, see tapleaf_witness_size()."""
+        sat_sizes = sat_sizes or {}
+        return [(leaf, tapleaf_witness_size(leaf, depth, worst_case, sat_sizes.get(leaf.script)) / 4) for leaf, depth in self.leaf_depths()]
+
+    def spend_cost(self, probabilities=None, sat_sizes=None):
+        """Return the (expected, worst-case) witness vbytes of a script path spend.
+
+        probabilities: dict mapping leaf scripts to spend probabilities or
+        weights. Leaves which are missing are never spent. If None, all
+        leaves are equally likely. The worst case is the largest witness of
+        any leaf which may be spent, with worst-case satisfactions. No
+        hashing or signing is done, so this is cheap enough to compare many
+        candidate trees. See spend_costs() for `sat_sizes`."""
+        costs = self.spend_costs(sat_sizes=sat_sizes)
+        worst_costs = self.spend_costs(True, sat_sizes)
+        if probabilities is None:
+            return sum(cost for _, cost in costs) / len(costs), max(cost for _, cost in worst_costs)
+        total = 0
+        expected = 0
+        for leaf, cost in costs:
+            p = probabilities.get(leaf.script, 0)
+            total += p
+            expected += p * cost
+        if total == 0:
+            raise Exception('No leaf has a spend probability.')
+        worst = max(cost for leaf, cost in worst_costs if probabilities.get(leaf.script, 0))
+        return expected / total, worst
 
     def set_key(self, data):
         self.key.set(data)
 
+    def serialize(self, with_hashes=False):
+        f = BytesIO()
+        self.stream_serialize(f, with_hashes)
+        return f.getvalue()
+
+    def stream_serialize(self, f, with_hashes=False):
+        """Write the tree to file-like object `f` in the binary TapTree format.
+
+        Format: serialization version (1 byte), flags (1 byte), internal key
+        (32 bytes, if TAPTREE_FLAG_KEY), leaf count (compact size), one shape
+        bit per node in preorder (1 = branch, 0 = leaf, LSB first), the 32-byte
+        tagged hash of every node in preorder (if TAPTREE_FLAG_HASHES), then
+        the leaf version byte and script of every leaf from left to right.
+
+        Only leaf versions and scripts are stored, not leaf descriptors."""
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                raise Exception('Cannot serialize a tree with missing nodes.')
+            nodes.append(node)
+            if isinstance(node, Tapbranch):
+                stack.append(node.right)
+                stack.append(node.left)
+        leaves = [node for node in nodes if isinstance(node, TapLeaf)]
+        flags = (TAPTREE_FLAG_KEY if self.key.valid else 0) | (TAPTREE_FLAG_HASHES if with_hashes else 0)
+        f.write(bytes([TAPTREE_SERIALIZATION_VERSION, flags]))
+        if self.key.valid:
+            f.write(self.key.get_bytes())
+        f.write(ser_compact_size(len(leaves)))
+        shape = bytearray((len(nodes) + 7) // 8)
+        for idx, node in enumerate(nodes):
+            if isinstance(node, Tapbranch):
+                shape[idx >> 3] |= 1 << (idx & 7)
+        f.write(bytes(shape))
+        if with_hashes:
+            self.root.tagged_hash()
+            f.write(b''.join(node.tagged_hash() for node in nodes))
+        for leaf in leaves:
+            f.write(bytes([leaf.version]))
+            f.write(ser_string(leaf.script))
+
+    def deserialize(self, f, verify=False):
+        """Read a tree in the binary TapTree format from file-like object `f`.
+
+        Leaves are given a raw() descriptor. Node hashes stored in the data
+        are taken as-is, unless `verify` is set: then they are recomputed
+        from the leaves and a mismatch raises."""
+        header = f.read(2)
+        if len(header) != 2 or header[0] != TAPTREE_SERIALIZATION_VERSION:
+            raise Exception('Unknown TapTree serialization version.')
+        flags = header[1]
+        if flags & ~(TAPTREE_FLAG_KEY | TAPTREE_FLAG_HASHES):
+            raise Exception('Unknown TapTree serialization flags.')
+        if flags & TAPTREE_FLAG_KEY:
+            key = ECPubKey()
+            key.set(f.read(32))
+            if not key.is_valid:
+                raise Exception('Invalid internal key.')
+            self.key = key
+        n_leaves = deser_compact_size(f)
+        if n_leaves == 0:
+            raise Exception('Cannot deserialize a tree without leaves.')
+        n_nodes = 2 * n_leaves - 1
+        shape = f.read((n_nodes + 7) // 8)
+        if len(shape) != (n_nodes + 7) // 8:
+            raise Exception('Truncated TapTree serialization.')
+        hashes = None
+        if flags & TAPTREE_FLAG_HASHES:
+            data = f.read(32 * n_nodes)
+            if len(data) != 32 * n_nodes:
+                raise Exception('Truncated TapTree serialization.')
+            hashes = [data[i:i + 32] for i in range(0, len(data), 32)]
+
+        nodes = []
+        # Branches still waiting for a child, innermost last.
+        stack = []
+        for idx in range(n_nodes):
+            if (shape[idx >> 3] >> (idx & 7)) & 1:
+                node = Tapbranch()
+            else:
+                version = f.read(1)
+                if len(version) != 1:
+                    raise Exception('Truncated TapTree serialization.')
+                node = TapLeaf(version=version[0])
+                node._script = CScript(deser_string(f))
+                node.desc = 'ts(raw(' + node._script.hex() + '))'
+            if idx > 0:
+                if not stack:
+                    raise Exception('Malformed TapTree shape.')
+                # All nodes are new, so children are linked directly
+                # without invalidating any hashes.
+                parent = stack[-1]
+                if parent._left is None:
+                    parent._left = node
+                else:
+                    parent._right = node
+                    stack.pop()
+                node._parents.add(parent)
+            if isinstance(node, Tapbranch):
+                if len(stack) >= TAPROOT_CONTROL_MAX_NODE_COUNT:
+                    raise Exception('Taproot tree exceeds maximum depth of %d.' % TAPROOT_CONTROL_MAX_NODE_COUNT)
+                stack.append(node)
+            nodes.append(node)
+        if stack or (n_nodes & 7 and shape[-1] >> (n_nodes & 7)):
+            raise Exception('Malformed TapTree shape.')
+        if hashes is not None:
+            if verify:
+                nodes[0].tagged_hash()
+                if any(node._hash != h for node, h in zip(nodes, hashes)):
+                    raise Exception('TapTree node hashes do not match its leaves.')
+            else:
+                for node, h in zip(nodes, hashes):
+                    node._hash = h
+        self.root = nodes[0]
+        return self
+
     @property
     def desc(self):
         assert self.key.valid == True, "Valid internal key must be set."
@@ -1111,105 +1823,292 @@ class TapTree:
         res += ')'
         return res
 
-    def construct(self):
+    def construct(self, processes=None):
+        """Return the (script, tweak, control_map) triple for this tree.
+
+        If `processes` is set, the tree is hashed by that many worker processes
+        with taproot_tree_helper_parallel(). This gives the same result, but
+        does not fill the node hash caches."""
+        if processes is not None:
+            return self._construct_parallel(processes)
+        tweak, tweaked = self._tweak()
+        blocks = list(self.control_blocks())
+        control_map = dict((leaf.script, control) for leaf, control in blocks)
+        # replace_leaf() can only patch a map with one entry per leaf.
+        if len(control_map) == len(blocks):
+            self._constructed = (self.root, self.root.tagged_hash(), self.key.get_bytes(), tweaked.get_y() & 1, control_map)
+        else:
+            self._constructed = None
+        return (CScript([OP_1, tweaked.get_bytes()]), tweak, dict(control_map))
+
+    def _construct_parallel(self, processes):
         assert self.key.valid == True, "Valid internal key must be set."
-        ctrl, h = self._constructor(self.root)
+        # Describe the tree as nested [left, right] lists of (version, script).
+        scripts = [None]
+        stack = [(self.root, scripts, 0)]
+        while stack:
+            node, parent, pos = stack.pop()
+            if isinstance(node, TapLeaf):
+                parent[pos] = (node.version, node.script)
+            else:
+                parent[pos] = [None, None]
+                stack.append((node.left, parent[pos], 0))
+                stack.append((node.right, parent[pos], 1))
+        ctrl, h = taproot_tree_helper_parallel(scripts, processes)
         tweak = tagged_hash("TapTweak", self.key.get_bytes() + h)
         tweaked = self.key.tweak_add(tweak)
-        control_map = dict((script, GetVersionTaggedPubKey(self.key, version, tweaked) + control) for version, script, control in ctrl)
+        headers = {}
+        control_map = {}
+        for version, script, control in ctrl:
+            if version not in headers:
+                headers[version] = GetVersionTaggedPubKey(self.key, version, tweaked)
+            control_map[script] = headers[version] + control
         return (CScript([OP_1, tweaked.get_bytes()]), tweak, control_map)
 
-    @staticmethod
-    def _constructor(node):
-        if isinstance(node, TapLeaf):
-            h = node.tagged_hash()
-            ctrl = [(node.version, node.script, bytes())]
-            return ctrl, h
-        if isinstance(node.left, TapLeaf):
-            h_l = node.left.tagged_hash()
-            ctrl_l = [(node.left.version, node.left.script, bytes())]
-        else:
-            ctrl_l, h_l  = TapTree._constructor(node.left)
-        if isinstance(node.right, TapLeaf):
-            h_r = node.right.tagged_hash()
-            ctrl_r = [(node.right.version, node.right.script, bytes())]
-        else:
-            ctrl_r, h_r = TapTree._constructor(node.right)
+    def output(self):
+        """Return the (script, tweak) pair of construct() without building any control blocks."""
+        tweak, tweaked = self._tweak()
+        return (CScript([OP_1, tweaked.get_bytes()]), tweak)
+
+    def control_block(self, leaf):
+        """Return the control block for spending TapLeaf `leaf`.
+
+        Only the sibling hashes along the leaf's merkle path are read, so once
+        the tree has been hashed this is O(depth)."""
+        path = self._path_to_root(leaf)
+        if path is None:
+            raise Exception('TapLeaf not found in tree.')
+        if len(path) > TAPROOT_CONTROL_MAX_NODE_COUNT:
+            raise Exception('Taproot tree exceeds maximum depth of %d.' % TAPROOT_CONTROL_MAX_NODE_COUNT)
+        _, tweaked = self._tweak()
+        control = GetVersionTaggedPubKey(self.key, leaf.version, tweaked)
+        child = leaf
+        for branch in path:
+            sibling = branch.right if branch.left is child else branch.left
+            control += sibling.tagged_hash()
+            child = branch
+        return control
+
+    def control_blocks(self):
+        """Iterate over (TapLeaf, control block) pairs, from the leftmost leaf to the rightmost."""
+        _, tweaked = self._tweak()
+        headers = {}
+        # Sibling hashes of the nodes on the current path, from the root down.
+        path = []
+        stack = [(self.root, 0, None)]
+        while stack:
+            node, depth, sibling_h = stack.pop()
+            del path[depth:]
+            if sibling_h is not None:
+                path.append(sibling_h)
+            if len(path) > TAPROOT_CONTROL_MAX_NODE_COUNT:
+                raise Exception('Taproot tree exceeds maximum depth of %d.' % TAPROOT_CONTROL_MAX_NODE_COUNT)
+            if isinstance(node, TapLeaf):
+                header = headers.get(node.version)
+                if header is None:
+                    header = headers[node.version] = GetVersionTaggedPubKey(self.key, node.version, tweaked)
+                yield node, header + b''.join(reversed(path))
+            else:
+                stack.append((node.right, len(path), node.left.tagged_hash()))
+                stack.append((node.left, len(path), node.right.tagged_hash()))
 
-        ctrl_l = [(version, script, ctrl + h_r) for version, script, ctrl in ctrl_l]
-        ctrl_r = [(version, script, ctrl + h_l) for version, script, ctrl in ctrl_r]
-        if h_r < h_l:
-            h_r, h_l = h_l, h_r
-        h = tagged_hash("TapBranch", h_l + h_r)
-        return (ctrl_l + ctrl_r , h)
+    def _tweak(self):
+        """Return the (tweak, tweaked key) pair, cached until the key or the tree changes."""
+        assert self.key.valid == True, "Valid internal key must be set."
+        key_data = self.key.get_bytes()
+        h = self.root.tagged_hash()
+        cached = self._tweak_cache
+        if cached is None or cached[0] != key_data or cached[1] != h:
+            tweak = tagged_hash("TapTweak", key_data + h)
+            cached = (key_data, h, tweak, self.key.tweak_add(tweak))
+            self._tweak_cache = cached
+        return cached[2], cached[3]
+
+    def replace_leaf(self, old, new):
+        """Replace TapLeaf `old` in this tree with `new`.
+
+        Returns the same (script, tweak, control_map) triple as construct().
+        Only the hashes on the path from `new` up to the root are recomputed.
+        If the tree is unchanged since the last construct() or replace_leaf()
+        call, the previous control map is patched rather than rebuilt: every
+        other leaf's control block only differs in the one path entry that
+        lies on the changed path (and in the parity bit). Trees with several
+        leaves of the same script are always rebuilt."""
+        assert self.key.valid == True, "Valid internal key must be set."
+        path = self._path_to_root(old)
+        if path is None:
+            raise Exception('TapLeaf not found in tree.')
+        cached = self._constructed
+        reusable = cached is not None and cached[0] is self.root and cached[1] == self.root._hash and cached[2] == self.key.get_bytes()
+        if any(branch._interned for branch in path):
+            # Shared with other trees: replace the path by modified copies.
+            path = self._copy_path(path, old, new)
+        elif path:
+            if path[0].left is old:
+                path[0].left = new
+            else:
+                path[0].right = new
+        else:
+            self.root = new
+        if not reusable:
+            return self.construct()
+
+        _, _, key_data, parity, old_map = cached
+        if new.script != old.script and new.script in old_map:
+            # Another leaf has the same script.
+            return self.construct()
+        h = self.root.tagged_hash()
+        tweak, tweaked = self._tweak()
+        new_parity = tweaked.get_y() & 1
+        control_map = dict(old_map)
+        control_map.pop(old.script, None)
+        if new_parity != parity:
+            for script, control in control_map.items():
+                control_map[script] = bytes([control[0] ^ 1]) + control[1:]
+
+        # Below each branch on the path, the leaves of the sibling subtree
+        # commit to the new hash of the on-path child at the entry matching
+        # their depth below that sibling.
+        child = new
+        siblings = []
+        for branch in path:
+            sibling = branch.right if branch.left is child else branch.left
+            child_h = child.tagged_hash()
+            stack = [(sibling, 0)]
+            while stack:
+                node, depth = stack.pop()
+                if isinstance(node, TapLeaf):
+                    control = control_map[node.script]
+                    pos = 33 + 32 * depth
+                    control_map[node.script] = control[:pos] + child_h + control[pos + 32:]
+                else:
+                    stack.append((node.left, depth + 1))
+                    stack.append((node.right, depth + 1))
+            siblings.append(sibling.tagged_hash())
+            child = branch
+        control_map[new.script] = GetVersionTaggedPubKey(self.key, new.version, tweaked) + b''.join(siblings)
+        self._constructed = (self.root, h, key_data, new_parity, control_map)
+        return (CScript([OP_1, tweaked.get_bytes()]), tweak, dict(control_map))
+
+    def _copy_path(self, path, old, new):
+        """Set the root to a copy of the branches on `path` (from `old` up), with `old` replaced by `new`."""
+        copies = []
+        child, copy = old, new
+        for branch in path:
+            if branch.left is child:
+                copy = Tapbranch(copy, branch.right)
+            else:
+                copy = Tapbranch(branch.left, copy)
+            copies.append(copy)
+            child = branch
+        self.root = copy
+        return copies
+
+    def _path_to_root(self, node):
+        """Return the Tapbranches from `node`'s parent up to the root, or None if `node` is not in this tree."""
+        path = self._indexed_path(node)
+        if path is None:
+            # The tree changed since the index was built (or never was).
+            index = {}
+            stack = [self.root]
+            while stack:
+                branch = stack.pop()
+                if isinstance(branch, Tapbranch):
+                    for child in (branch.left, branch.right):
+                        index.setdefault(id(child), branch)
+                        stack.append(child)
+            self._parent_index = index
+            path = self._indexed_path(node)
+        return path
+
+    def _indexed_path(self, node):
+        """Walk up the per-tree parent index, checking every step against the current tree."""
+        index = self._parent_index
+        if index is None:
+            return None
+        path = []
+        child = node
+        while child is not self.root:
+            parent = index.get(id(child))
+            if parent is None or (parent.left is not child and parent.right is not child) or len(path) > len(index):
+                return None
+            path.append(parent)
+            child = parent
+        return path
 
     @staticmethod
     def _encode_tree(node):
-        string = '['
         if isinstance(node, TapLeaf):
-            string += node.desc
-            string += ']'
-            return string
-        if isinstance(node.left, TapLeaf):
-            string += node.left.desc
-        else:
-            string += TapTree._encode_tree(node.left)
-        string += ','
-        if isinstance(node.right, TapLeaf):
-            string += node.right.desc
-        else:
-            string += TapTree._encode_tree(node.right)
-        string += ']'
-        return string
-
-    def _decode_tree(self, string, parent=None):
-        l, r = TapTree._parse_tuple(string)
-        if not r:
-            self.root = TapLeaf()
-            self.root.from_desc(l)
-            return
-        if (l[0] == '[' and l[-1] == ']'):
-            parent.left = Tapbranch()
-            self._decode_tree(l, parent=parent.left)
-        else:
-            parent.left = TapLeaf()
-            parent.left.from_desc(l)
-        if (r[0] == '[' and r[-1] == ']'):
-            parent.right = Tapbranch()
-            self._decode_tree(r, parent=parent.right)
-        else:
-            parent.right = TapLeaf()
-            parent.right.from_desc(r)
-
-    @staticmethod
-    def _parse_tuple(ts):
-        ts = ts[1:-1]
-        depth = 0
-        l, r = None, None
-        for idx, ch in enumerate(ts):
-            if depth == 0 and ch == ',':
-                l,r = ts[:idx], ts[idx+1:]
-                break
-            if ch == '[' or ch == '(':
-                depth += 1
-            if ch == ']' or ch == ')':
-                depth -= 1
-        if depth == 0 and (l and r):
-            return l, r
-        elif depth == 0:
-            return ts, ''
-        else:
-            # Malformed tuple.
-            raise Exception
+            return '[' + node.desc + ']'
+        # Emit tokens from an explicit stack; leaves below the root are not
+        # bracketed.
+        parts = []
+        stack = [node]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+            elif isinstance(item, TapLeaf):
+                parts.append(item.desc)
+            else:
+                stack.extend((']', item.right, ',', item.left, '['))
+        return ''.join(parts)
 
 class Tapbranch():
     # Internal Taptree branch.
     def __init__(self, left=None, right=None):
-        self.left = left
-        self.right = right
+        # Cached tagged hash, reset whenever a node below this branch changes.
+        self._hash = None
+        self._parents = weakref.WeakSet()
+        self._interned = False
+        self._left = left
+        self._right = right
+        _link_child(self, left)
+        _link_child(self, right)
+
+    @property
+    def left(self):
+        return self._left
+
+    @left.setter
+    def left(self, node):
+        _check_mutable(self)
+        _unlink_child(self, self._left)
+        self._left = node
+        _link_child(self, node)
+        self._invalidate()
+
+    @property
+    def right(self):
+        return self._right
+
+    @right.setter
+    def right(self, node):
+        _check_mutable(self)
+        _unlink_child(self, self._right)
+        self._right = node
+        _link_child(self, node)
+        self._invalidate()
+
+    def _invalidate(self):
+        """Drop the cached hash of this branch and of all branches above it."""
+        self._hash = None
+        _invalidate_parents(self)
 
     def tagged_hash(self):
-        return tagged_hash("TapBranch", b''.join(sorted([self.left.tagged_hash(),self.right.tagged_hash()])))
+        if self._hash is None:
+            # Hash the uncached branches below bottom-up without recursing.
+            stack = [self]
+            while stack:
+                node = stack[-1]
+                pending = [child for child in (node.left, node.right) if isinstance(child, Tapbranch) and child._hash is None]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                if node._hash is None:
+                    node._hash = tapbranch_hash(node.left.tagged_hash(), node.right.tagged_hash())
+        return self._hash
 
     def __lt__(self, other):
         return self.tagged_hash() < other.tagged_hash()
@@ -1217,93 +2116,234 @@ class Tapbranch():
     def __gt__(self, other):
         return self.tagged_hash() > other.tagged_hash()
 
+def _check_mutable(node):
+    if node._interned:
+        raise Exception('Interned nodes are shared between trees and cannot be modified.')
+
+def _link_child(parent, node):
+    if node is not None:
+        node._parents.add(parent)
+
+def _unlink_child(parent, node):
+    # Called before the child is replaced; keep the link if the node is
+    # also the other child.
+    if node is not None and not (parent._left is node and parent._right is node):
+        node._parents.discard(parent)
+
+def _invalidate_parents(node):
+    # A branch can only hold a cached hash if all nodes below it do, so the
+    # walk up can stop at the first branch without one.
+    if not node._parents:
+        return
+    stack = list(node._parents)
+    while stack:
+        parent = stack.pop()
+        if parent._hash is not None:
+            parent._hash = None
+            stack.extend(parent._parents)
+
+class TapNodeStore:
+    """Content-addressed store which interns TapLeaf and Tapbranch nodes, so
+    that identical subtrees of many TapTrees are allocated and hashed once.
+
+    Leaves are keyed by (version, script) and branches by their interned
+    children, which identifies a subtree exactly like its tagged hash does
+    (but preserves child order) without having to hash duplicates. Nodes
+    handed out by the store are shared between trees, so modifying them
+    raises. TapTree.replace_leaf() copies the interned branches on the path
+    instead."""
+
+    def __init__(self):
+        self._leaves = {}
+        self._branches = {}
+        # Number of nodes requested from the store, and estimated bytes of
+        # the duplicates which did not need to be allocated.
+        self.requested = 0
+        self.bytes_saved = 0
+
+    def __len__(self):
+        return len(self._leaves) + len(self._branches)
+
+    def leaf(self, script, version=DEFAULT_TAPSCRIPT_VER):
+        """Return the interned TapLeaf for `script`."""
+        return self._intern_leaf(version, CScript(script), None)
+
+    def branch(self, left, right):
+        """Return the interned Tapbranch over the interned nodes `left` and `right`."""
+        self.requested += 1
+        key = (id(left), id(right))
+        node = self._branches.get(key)
+        if node is not None:
+            self.bytes_saved += _node_size(node)
+            return node
+        node = Tapbranch(left, right)
+        node._interned = True
+        self._branches[key] = node
+        return node
+
+    def _intern_leaf(self, version, script, source):
+        self.requested += 1
+        key = (version, bytes(script))
+        node = self._leaves.get(key)
+        if node is not None:
+            self.bytes_saved += _node_size(node)
+            return node
+        node = TapLeaf(version=version)
+        node._script = script
+        node.desc = 'ts(raw(' + script.hex() + '))'
+        if source is not None:
+            node._hash = source._hash
+            node.miniscript = source.miniscript
+            node.sat = source.sat
+            if hasattr(source, 'desc'):
+                node.desc = source.desc
+        node._interned = True
+        self._leaves[key] = node
+        return node
+
+    def intern(self, node):
+        """Return the interned copy of the subtree below `node`, adding any missing nodes."""
+        # Children are interned before their parents, without recursion.
+        interned = {}
+        stack = [node]
+        while stack:
+            item = stack[-1]
+            if isinstance(item, TapLeaf):
+                stack.pop()
+                interned[id(item)] = self._intern_leaf(item.version, item.script, item)
+                continue
+            pending = [child for child in (item.left, item.right) if id(child) not in interned]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            if id(item) not in interned:
+                interned[id(item)] = self.branch(interned[id(item.left)], interned[id(item.right)])
+        return interned[id(node)]
+
+    def intern_tree(self, tree):
+        """Replace the nodes of TapTree `tree` by interned ones. Returns `tree`."""
+        tree.root = self.intern(tree.root)
+        return tree
+
+    def stats(self):
+        """Return a dict describing the savings of the store so far."""
+        return {
+            'requested': self.requested,
+            'unique': len(self),
+            'hashes_saved': self.requested - len(self),
+            'bytes_saved': self.bytes_saved,
+        }
+
+def _node_size(node):
+    """Estimate the memory used by a single TapLeaf or Tapbranch object."""
+    size = sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node._parents)
+    if isinstance(node, TapLeaf):
+        size += sys.getsizeof(node.script)
+    return size
+
 # Miniscript Node.
 class node_type:
-    def __init__(self, script=False, nsat=False, sat_xy=False, sat_z=False, typ=False, corr=False, mal=False, children=False, childnum=None):
+    def __init__(self, script=False, nsat=False, sat_xy=False, sat_z=False, sat_size=False, max_sat_size=False, max_stack=False, sig_count=False, typ=False, corr=False, mal=False, satisfy=False, children=False, childnum=None):
         self._script = script
         self._nsat = nsat
         self._sat_xy = sat_xy
         self._sat_z= sat_z
+        self._sat_size = sat_size
+        # Worst case satisfaction size, peak stack size and signature checks.
+        self._max_sat_size = max_sat_size
+        self._max_stack = max_stack
+        self._sig_count = sig_count
         self._typ = typ
         self._corr = corr
         self._mal = mal
+        # Called as satisfy(children, satisfier), see Satisfier.
+        self._satisfy = satisfy
         self.children = children # [x,y,z]
 
-        # Assert all corr/mal/child members are defined.
-        assert(all (key in corr(children).keys() for key in ('z','o','n','d','u')))
         for _ , value in vars(self).items():
             assert(value != None)
+        # Children are constructed first, so evaluating all properties here
+        # computes them bottom-up, once per node, from the children's cached
+        # values. satisfy depends on a Satisfier and is called on demand.
+        for name in ('script', 'nsat', 'sat_xy', 'sat_z', 'sat_size', 'max_sat_size', 'max_stack', 'sig_count', 'typ', 'corr', 'mal'):
+            getattr(self, name)
+        # Assert all corr/mal/child members are defined.
+        assert(all (key in self.corr.keys() for key in ('z','o','n','d','u')))
         # assert(len(children)==3) # This doesn't hold with threshold.
 
     def __getattr__(self,name):
-        attr = getattr(self, '_'+name)
-        if attr != None:
-            # All lambda's must accept children argument.
-            return attr(self.children)
-        else:
-            return None
+        # Only called on a cache miss: evaluate the lambda and memoise the
+        # result as an instance attribute. Nodes are immutable once built.
+        attr = self.__dict__.get('_'+name)
+        if attr is None:
+            raise AttributeError(name)
+        # All lambda's must accept children argument.
+        value = attr(self.children)
+        self.__dict__[name] = value
+        return value
+
+# Miniscript wrappers, which take a single expression.
+MINISCRIPT_WRAPPERS = ('c', 'v')
 
 # Factory class to generate miniscript nodes.
 class miniscript:
     @staticmethod
     def decode(string):
-        tag, exprs = miniscript._parse(string)
-
-        # Return terminal expressions:
-        # ['pk','pk_h','older','after','sha256','hash256','hash160','hash160','1','0']:
-        if tag in ['pk','pk_h', 'older', 'hash160', 'thresh_csa']:
-
-            if tag in ['pk', 'pk_h']:
-                key_b = bytes.fromhex(exprs[0])
-                return getattr(miniscript, tag)(key_b)
-
-            elif tag in ['older']:
-                n = int(exprs[0])
-                return getattr(miniscript, tag)(n)
-
-            elif tag in ['hash160']:
-                digest = bytes.fromhex(exprs[0])
-                return getattr(miniscript, tag)(digest)
-
-            elif tag in ['thresh_csa']:
-                k = int(exprs[0])
-                keys = []
-                for key_string in exprs[1:]:
-                    key_data = bytes.fromhex(key_string)
-                    keys.append(key_data)
-                return getattr(miniscript, tag)(k, *keys)
-
-        child_nodes = []
-        for expr in exprs:
-            child_nodes.append(miniscript.decode(expr))
-        return getattr(miniscript, tag)(*child_nodes)
+        """Parse a miniscript expression, such as and_v(v:c:pk(KEY),older(N)), into a node."""
+        tokens = DescriptorTokenizer(string)
+        node = miniscript._parse(tokens)
+        tokens.end()
+        return node
 
     @staticmethod
-    def _parse(string):
-        # TODO: Handle single arg case.
-        string = ''.join(string.split())
-        depth = 0
-        tag = ''
-        exprs = []
-        for idx, ch in enumerate(string):
-            if ch == ':' and depth == 0:
-                return string[:idx], [string[idx+1:]]
-            if ch == '(':
-                depth += 1
-                if depth == 1:
-                    tag = string[:idx]
-                    prev_idx = idx
-            if ch == ')':
-                depth -= 1
-                if depth == 0:
-                    exprs.append(string[prev_idx+1:idx])
-            if depth == 1 and ch == ',':
-                exprs.append(string[prev_idx+1:idx])
-                prev_idx = idx
-        if depth == 0 and bool(tag) and bool(exprs):
-            return tag, exprs
+    def _parse(tokens):
+        """Parse one expression from a DescriptorTokenizer, descending into its arguments."""
+        name, pos = tokens.word('miniscript fragment')
+        if tokens.accept(':'):
+            # Wrappers such as v:c:pk(K) or vc:pk(K), applied right to left.
+            for idx, wrapper in enumerate(name):
+                if wrapper not in MINISCRIPT_WRAPPERS:
+                    raise DescriptorParseError("Unknown wrapper '%s'" % wrapper, pos + idx)
+            node = miniscript._parse(tokens)
+            for wrapper in reversed(name):
+                node = getattr(miniscript, wrapper)(node)
+            return node
+        tokens.expect('(')
+        if name in MINISCRIPT_WRAPPERS:
+            node = getattr(miniscript, name)(miniscript._parse(tokens))
+        elif name == 'pk':
+            key, key_pos = _desc_bytes(tokens.word('key'))
+            if len(key) != 32:
+                raise DescriptorParseError('Expected a 32-byte key', key_pos)
+            node = miniscript.pk(key)
+        elif name == 'older':
+            arg = tokens.word('number')
+            n = _desc_int(arg)
+            if n < 1 or n >= 2**32:
+                raise DescriptorParseError('Invalid relative timelock', arg[1])
+            node = miniscript.older(n)
+        elif name == 'hash160':
+            node = miniscript.hash160(_desc_hash160(tokens.word('hash')))
+        elif name == 'and_v':
+            left = miniscript._parse(tokens)
+            tokens.expect(',')
+            node = miniscript.and_v(left, miniscript._parse(tokens))
+        elif name == 'thresh_csa':
+            k = _desc_int(tokens.word('threshold'))
+            keys = []
+            while tokens.accept(','):
+                key, key_pos = _desc_bytes(tokens.word('key'))
+                if len(key) != 32:
+                    raise DescriptorParseError('Expected a 32-byte key', key_pos)
+                keys.append(key)
+            if len(keys) < 2 or not 1 <= k <= len(keys):
+                raise DescriptorParseError('Invalid threshold', pos)
+            node = miniscript.thresh_csa(k, *keys)
         else:
-            raise Exception('Malformed miniscript string.')
+            raise DescriptorParseError("Unknown miniscript fragment '%s'" % name, pos)
+        tokens.expect(')')
+        return node
 
     @staticmethod
     def pk(key):
@@ -1312,11 +2352,16 @@ class miniscript:
         nsat = lambda x: [0]
         sat_xy = lambda x: [('sig', key)]
         sat_z = lambda x: [False]
+        sat_size = lambda x: 1 + 64 # Signature push (SIGHASH_DEFAULT).
+        max_sat_size = lambda x: 1 + 65 # Signature push with explicit sighash type.
+        max_stack = lambda x: 2 # Signature and key.
+        sig_count = lambda x: 0 # Checked by c:.
         typ = lambda x: 'K' # Only one possible.
         corr = lambda x: {'z': False,'o': True, 'n': True, 'd': True, 'u': True}
         mal = lambda x: {'e': True,'f': False, 'm': True, 's': True}
+        satisfy = lambda x, s: (s.signature(key), [b''])
         children = [None, None, None] # Terminal.
-        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
+        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z, sat_size=sat_size, max_sat_size=max_sat_size, max_stack=max_stack, sig_count=sig_count, typ=typ, corr=corr, mal=mal, satisfy=satisfy, children=children)
 
     @staticmethod
     def older(n):
@@ -1325,11 +2370,16 @@ class miniscript:
         nsat = lambda x: [False]
         sat_xy = lambda x: []
         sat_z = lambda x: [False]
+        sat_size = lambda x: 0
+        max_sat_size = lambda x: 0
+        max_stack = lambda x: 1
+        sig_count = lambda x: 0
         typ = lambda x: 'B'
         corr = lambda x: {'z': True,'o': False, 'n': False, 'd': False, 'u': False}
         mal = lambda x: {'e': False,'f': True, 'm': True, 's': False}
+        satisfy = lambda x, s: ([] if s.older(n) else None, None)
         children = [None, None, None] # Terminal.
-        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
+        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z, sat_size=sat_size, max_sat_size=max_sat_size, max_stack=max_stack, sig_count=sig_count, typ=typ, corr=corr, mal=mal, satisfy=satisfy, children=children)
 
     @staticmethod
     def hash160(data):
@@ -1338,11 +2388,16 @@ class miniscript:
         nsat = lambda x: [b'\x00'*32] # Not non-malleably.
         sat_xy = lambda x: [('preimage', data)]
         sat_z = lambda x: [False]
+        sat_size = lambda x: 1 + 32 # Preimage push.
+        max_sat_size = lambda x: 1 + 32
+        max_stack = lambda x: 3 # Preimage, its size and 32.
+        sig_count = lambda x: 0
         typ = lambda x: 'B'
         corr = lambda x: {'z': False,'o': True, 'n': True, 'd': True, 'u': True}
         mal = lambda x: {'e': False,'f': False, 'm': True, 's': False}
+        satisfy = lambda x, s: (s.preimage(data), [b'\x00'*32])
         children = [None, None, None] # Terminal.
-        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
+        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z, sat_size=sat_size, max_sat_size=max_sat_size, max_stack=max_stack, sig_count=sig_count, typ=typ, corr=corr, mal=mal, satisfy=satisfy, children=children)
 
     @staticmethod
     def c(expr):
@@ -1350,11 +2405,16 @@ class miniscript:
         nsat = lambda x: x[0].nsat
         sat_xy = lambda x: x[0].sat_xy
         sat_z = lambda x: [False]
+        sat_size = lambda x: x[0].sat_size
+        max_sat_size = lambda x: x[0].max_sat_size
+        max_stack = lambda x: x[0].max_stack
+        sig_count = lambda x: x[0].sig_count + 1
         typ = lambda x: 'B' if x[0].typ == 'K' else False
         corr = lambda x: {'z': False,'o': x[0].corr['o'], 'n': x[0].corr['n'], 'd': x[0].corr['d'], 'u': True}
         mal = lambda x: {'f': False, 'e': x[0].mal['e'], 'm': x[0].mal['m'], 's': x[0].mal['s']}
+        satisfy = lambda x, s: s.satisfy(x[0])
         children = [expr, None, None]
-        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
+        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z, sat_size=sat_size, max_sat_size=max_sat_size, max_stack=max_stack, sig_count=sig_count, typ=typ, corr=corr, mal=mal, satisfy=satisfy, children=children)
 
     @staticmethod
     def v(expr):
@@ -1362,11 +2422,16 @@ class miniscript:
         nsat = lambda x: [False]
         sat_xy = lambda x: x[0].sat_xy
         sat_z = lambda x: [False]
+        sat_size = lambda x: x[0].sat_size
+        max_sat_size = lambda x: x[0].max_sat_size
+        max_stack = lambda x: x[0].max_stack
+        sig_count = lambda x: x[0].sig_count
         typ = lambda x: 'V' if x[0].typ == 'B' else False
         corr = lambda x: {'z': x[0].corr['z'],'o': x[0].corr['o'], 'n': x[0].corr['n'], 'd': False, 'u': False}
         mal = lambda x: {'f': True, 'e': False, 'm': x[0].mal['m'], 's': x[0].mal['s']}
+        satisfy = lambda x, s: (s.satisfy(x[0])[0], None)
         children = [expr, None, None]
-        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
+        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z, sat_size=sat_size, max_sat_size=max_sat_size, max_stack=max_stack, sig_count=sig_count, typ=typ, corr=corr, mal=mal, satisfy=satisfy, children=children)
 
     @staticmethod
     def and_v(expr_l, expr_r):
@@ -1374,6 +2439,11 @@ class miniscript:
         nsat = lambda x: [False]
         sat_xy = lambda x: x[1].sat_xy + x[0].sat_xy
         sat_z = lambda x: [False]
+        sat_size = lambda x: x[0].sat_size + x[1].sat_size
+        max_sat_size = lambda x: x[0].max_sat_size + x[1].max_sat_size
+        # The right hand side's items stay below while the left hand side runs.
+        max_stack = lambda x: max(len(x[1].sat_xy) + x[0].max_stack, x[1].max_stack)
+        sig_count = lambda x: x[0].sig_count + x[1].sig_count
         typ = lambda x:\
             'B' if (x[0].typ == 'V' and x[1].typ == 'B') else\
             'K' if (x[0].typ == 'V' and x[1].typ == 'K') else\
@@ -1389,8 +2459,9 @@ class miniscript:
             'e': False,\
             'm':bool(x[0].mal['m']*x[1].mal['m']),\
             's': bool(x[0].mal['s']+x[1].mal['s'])}
+        satisfy = lambda x, s: (Satisfier.concat(s.satisfy(x[1])[0], s.satisfy(x[0])[0]), None)
         children = [expr_l, expr_r, None]
-        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
+        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z, sat_size=sat_size, max_sat_size=max_sat_size, max_stack=max_stack, sig_count=sig_count, typ=typ, corr=corr, mal=mal, satisfy=satisfy, children=children)
 
     @staticmethod # TODO:
     def thresh_csa(k, *args): #arg[0] = k, arg[i>0] = expr_i
@@ -1401,8 +2472,337 @@ class miniscript:
         nsat = lambda x: [0x00]*len(args)
         sat_xy = lambda x: [('sig', args[i]) for i in range(0,len(args))][::-1] # TODO: ('thresh(n)', [('sig', (0x02../0x00)), ('sig', (0x02../0x00))])
         sat_z = lambda x: [False]
+        sat_size = lambda x: k * (1 + 64) + (len(args) - k) # k signatures, empty pushes for the other keys.
+        max_sat_size = lambda x: k * (1 + 65) + (len(args) - k)
+        max_stack = lambda x: len(args) + 1 # One item per key, and the key being checked.
+        sig_count = lambda x: k # Non-empty signatures, see bip-0342 validation weight.
         typ = lambda x: 'B'
         corr = lambda x: {'z': False,'o': False, 'n': False, 'd': True, 'u': True}
         mal = lambda x: {'f': False, 'e': True, 'm': True, 's': True}
+        satisfy = lambda x, s: (s.threshold(k, args), [b''] * len(args))
         children = [None, None, None] # Terminal expression.
-        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
+        return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z, sat_size=sat_size, max_sat_size=max_sat_size, max_stack=max_stack, sig_count=sig_count, typ=typ, corr=corr, mal=mal, satisfy=satisfy, children=children)
+
+class Satisfier:
+    """Build the smallest witnesses for miniscript nodes from available data.
+
+    signatures: dict mapping keys (32-byte x-only or ECPubKey) to signatures
+    preimages: dict mapping 20-byte hash160 digests to 32-byte preimages
+    sequence: nSequence of the spending input, for older() (None: unset)
+
+    Each node's (satisfaction, dissatisfaction) is computed once from those
+    of its children and cached. A witness stack is a list of byte strings,
+    bottom first, or None if unavailable."""
+
+    def __init__(self, signatures=None, preimages=None, sequence=None):
+        self.signatures = {}
+        for key, sig in (signatures or {}).items():
+            self.signatures[key.get_bytes() if isinstance(key, ECPubKey) else key] = sig
+        self.preimages = dict(preimages or {})
+        self.sequence = sequence
+        self._cache = {}
+
+    def signature(self, key):
+        sig = self.signatures.get(key)
+        return None if sig is None else [sig]
+
+    def preimage(self, digest):
+        preimage = self.preimages.get(digest)
+        return None if preimage is None else [preimage]
+
+    def older(self, n):
+        """Whether the input's nSequence satisfies OP_CHECKSEQUENCEVERIFY for `n` (bip-0112)."""
+        if n & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+            return True
+        if self.sequence is None or self.sequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+            return False
+        if (n & SEQUENCE_LOCKTIME_TYPE_FLAG) != (self.sequence & SEQUENCE_LOCKTIME_TYPE_FLAG):
+            return False
+        return (n & SEQUENCE_LOCKTIME_MASK) <= (self.sequence & SEQUENCE_LOCKTIME_MASK)
+
+    def threshold(self, k, keys):
+        """Satisfy `k` CHECKSIG(ADD)s over `keys` with the smallest available signatures."""
+        available = sorted((len(self.signatures[key]), idx) for idx, key in enumerate(keys) if key in self.signatures)
+        if len(available) < k:
+            return None
+        signing = set(idx for _, idx in available[:k])
+        # The first key is checked first, so its item is on top of the stack.
+        return [self.signatures[keys[idx]] if idx in signing else b'' for idx in range(len(keys) - 1, -1, -1)]
+
+    @staticmethod
+    def concat(*stacks):
+        if any(stack is None for stack in stacks):
+            return None
+        return [item for stack in stacks for item in stack]
+
+    @staticmethod
+    def stack_size(stack):
+        """Serialized size of a witness stack."""
+        return len(ser_compact_size(len(stack))) + sum(len(ser_string(item)) for item in stack)
+
+    def satisfy(self, node):
+        """Return (satisfaction, dissatisfaction) witness stacks for miniscript `node`."""
+        cached = self._cache.get(id(node))
+        if cached is None:
+            # Keep the node alive, so that its id is not reused.
+            cached = self._cache[id(node)] = (node._satisfy(node.children, self), node)
+        return cached[0]
+
+    def satisfy_leaf(self, leaf):
+        """Return the witness stack items satisfying TapLeaf `leaf` (without script and control block), or None."""
+        if leaf.miniscript is None:
+            return None
+        return self.satisfy(leaf.miniscript)[0]
+
+    def satisfy_tree(self, tree):
+        """Find the cheapest script path spend of TapTree `tree`.
+
+        Returns (TapLeaf, witness stack including script and control block),
+        or None if no leaf can be satisfied."""
+        best = None
+        for idx, (leaf, depth) in enumerate(tree.leaf_depths()):
+            stack = self.satisfy_leaf(leaf)
+            if stack is None:
+                continue
+            size = Satisfier.stack_size(stack + [leaf.script, bytes(33 + 32 * depth)])
+            if best is None or size < best[0]:
+                best = (size, idx, leaf, stack)
+        if best is None:
+            return None
+        _, _, leaf, stack = best
+        return leaf, stack + [leaf.script, tree.control_block(leaf)]
+
+# Spending policies.
+#
+# Policies are written as pk(KEY), older(N), hash160(HASH), and(X,Y,...),
+# or(X,Y,...) and thresh(K,pk(KEY),...), where or() alternatives may be
+# weighted as N@X. They are parsed into canonical tuples, in which the
+# arguments of commutative operators are sorted and nested and()s are
+# flattened, so equal policies are equal (and hash equally) as dict keys.
+
+def parse_policy(string):
+    """Parse a policy string into its canonical tuple form."""
+    tokens = DescriptorTokenizer(string)
+    policy = _parse_policy(tokens)
+    tokens.end()
+    return policy
+
+def _parse_policy(tokens):
+    name, pos = tokens.word('policy')
+    tokens.expect('(')
+    if name == 'pk':
+        policy = ('pk', _desc_key(tokens.word('key')).get_bytes())
+    elif name == 'older':
+        arg = tokens.word('number')
+        n = _desc_int(arg)
+        if n < 1 or n >= 2**31:
+            raise DescriptorParseError('Invalid relative timelock', arg[1])
+        policy = ('older', n)
+    elif name == 'hash160':
+        policy = ('hash160', _desc_hash160(tokens.word('hash')))
+    elif name in ('and', 'or'):
+        subs = []
+        while True:
+            weight = 1
+            if tokens.is_word and tokens.token.isdigit():
+                arg = tokens.word('weight')
+                weight = _desc_int(arg)
+                tokens.expect('@')
+                if name != 'or' or weight == 0:
+                    raise DescriptorParseError('Invalid weight', arg[1])
+            subs.append((weight, _parse_policy(tokens)))
+            if not tokens.accept(','):
+                break
+        if len(subs) < 2:
+            raise DescriptorParseError('%s() needs at least two arguments' % name, pos)
+        if name == 'or':
+            policy = ('or', tuple(sorted(subs, key=repr)))
+        else:
+            policy = _policy_and([sub for _, sub in subs])
+    elif name == 'thresh':
+        k = _desc_int(tokens.word('threshold'))
+        subs = []
+        while tokens.accept(','):
+            subs.append(_parse_policy(tokens))
+        if not 1 <= k <= len(subs):
+            raise DescriptorParseError('Invalid threshold', pos)
+        if k == len(subs):
+            policy = _policy_and(subs)
+        else:
+            if any(sub[0] != 'pk' for sub in subs):
+                raise DescriptorParseError('thresh() is only supported over pk()', pos)
+            policy = ('thresh', k, tuple(sorted(subs)))
+    else:
+        raise DescriptorParseError("Unknown policy '%s'" % name, pos)
+    tokens.expect(')')
+    return policy
+
+def _policy_and(subs):
+    flat = []
+    for sub in subs:
+        flat.extend(sub[1] if sub[0] == 'and' else [sub])
+    if len(flat) == 1:
+        return flat[0]
+    return ('and', tuple(sorted(flat, key=repr)))
+
+class PolicyCompiler:
+    """Compile spending policies to miniscript nodes.
+
+    A policy is first expanded into alternative conjunctions of pk(),
+    older(), hash160() and k-of-n thresh() terms, one per TapLeaf, with
+    the probability of it being spent. The cheapest miniscript for each
+    conjunction is then found by dynamic programming: every suffix of the
+    conjunction is compiled once, and the keys may be combined into a
+    single CHECKSIGADD threshold. The objective is script size plus
+    satisfaction size. Results are memoised on the canonical policy, so a
+    compiler can be reused for many policies sharing subpolicies."""
+
+    def __init__(self):
+        self._alternatives = {}
+        self._compiled = {}
+
+    def compile(self, policy):
+        """Return a list of (probability, miniscript node), most likely first."""
+        if isinstance(policy, str):
+            policy = parse_policy(policy)
+        compiled = [(p, self._compile_and(term)[1]) for term, p in self._expand(policy).items()]
+        compiled.sort(key=lambda item: -item[0])
+        return compiled
+
+    def _expand(self, policy):
+        """Return a dict mapping the conjunctions a policy can be satisfied with to their probabilities."""
+        ret = self._alternatives.get(policy)
+        if ret is not None:
+            return ret
+        if policy[0] == 'or':
+            total = sum(weight for weight, _ in policy[1])
+            ret = {}
+            for weight, sub in policy[1]:
+                for term, p in self._expand(sub).items():
+                    ret[term] = ret.get(term, 0) + p * weight / total
+        elif policy[0] == 'and':
+            ret = {(): 1}
+            for sub in policy[1]:
+                product = {}
+                for term, p in ret.items():
+                    for sub_term, q in self._expand(sub).items():
+                        key = tuple(sorted(set(term + sub_term), key=repr))
+                        product[key] = product.get(key, 0) + p * q
+                ret = product
+        else:
+            ret = {(policy,): 1}
+        self._alternatives[policy] = ret
+        return ret
+
+    def _compile_and(self, term):
+        """Return (cost, node) of the cheapest miniscript satisfied by all policies in `term`."""
+        ret = self._compiled.get(term)
+        if ret is not None:
+            return ret
+        if len(term) == 1:
+            node = PolicyCompiler._compile_atom(term[0])
+            ret = (PolicyCompiler._cost(node), node)
+        else:
+            # Either verify the first policy and compile the rest, or check
+            # all keys with one CHECKSIGADD threshold at the end.
+            rest = self._compile_and(term[1:])[1]
+            candidates = [miniscript.and_v(miniscript.v(PolicyCompiler._compile_atom(term[0])), rest)]
+            keys = [atom[1] for atom in term if atom[0] == 'pk']
+            if len(keys) > 1:
+                node = miniscript.thresh_csa(len(keys), *keys)
+                others = tuple(atom for atom in term if atom[0] != 'pk')
+                if others:
+                    node = miniscript.and_v(miniscript.v(self._compile_and(others)[1]), node)
+                candidates.append(node)
+            ret = min((PolicyCompiler._cost(node), idx, node) for idx, node in enumerate(candidates))[::2]
+        assert ret[1].typ == 'B'
+        self._compiled[term] = ret
+        return ret
+
+    @staticmethod
+    def _compile_atom(policy):
+        if policy[0] == 'pk':
+            return miniscript.c(miniscript.pk(policy[1]))
+        if policy[0] == 'older':
+            return miniscript.older(policy[1])
+        if policy[0] == 'hash160':
+            return miniscript.hash160(policy[1])
+        return miniscript.thresh_csa(policy[1], *(sub[1] for sub in policy[2]))
+
+    @staticmethod
+    def _cost(node):
+        return len(CScript(node.script)) + node.sat_size
+
+def compile_policy(policy):
+    """Compile a policy string or tuple, see PolicyCompiler.compile()."""
+    return PolicyCompiler().compile(policy)
+
+class TestFrameworkScript(unittest.TestCase):
+    def _random_tree(self, n):
+        """Return a TapTree with `n` distinct raw leaves in a random shape."""
+        _, pubkey = generate_bip340_key_pair()
+        nodes = []
+        for _ in range(n):
+            leaf = TapLeaf()
+            leaf.script = CScript([os.urandom(8), OP_DROP, OP_TRUE])
+            nodes.append(leaf)
+        leaves = list(nodes)
+        while len(nodes) > 1:
+            idx = random.randrange(len(nodes) - 1)
+            nodes[idx:idx + 2] = [Tapbranch(nodes[idx], nodes[idx + 1])]
+        return TapTree(key=pubkey, root=nodes[0]), leaves
+
+    def _fresh_construct(self, tree):
+        """construct() a copy of `tree` built from new nodes, so no cached state is shared."""
+        def copy(node):
+            if isinstance(node, TapLeaf):
+                leaf = TapLeaf(version=node.version)
+                leaf.script = node.script
+                return leaf
+            return Tapbranch(copy(node.left), copy(node.right))
+        return TapTree(key=tree.key, root=copy(tree.root)).construct()
+
+    def test_replace_leaf(self):
+        """Random replace_leaf() calls match a fresh construct(), also with duplicate leaf scripts."""
+        tree, leaves = self._random_tree(12)
+        tree.construct()
+        for i in range(40):
+            idx = random.randrange(len(leaves))
+            new = TapLeaf()
+            if i % 5 == 4:
+                # Duplicates another leaf's script, forcing a full rebuild.
+                new.script = random.choice(leaves).script
+            else:
+                new.script = CScript([os.urandom(8), OP_DROP, OP_TRUE])
+            self.assertEqual(tree.replace_leaf(leaves[idx], new), self._fresh_construct(tree))
+            leaves[idx] = new
+
+    def test_serialization(self):
+        """Serialized trees round-trip, with and without node hashes."""
+        tree, _ = self._random_tree(9)
+        expected = tree.construct()
+        for with_hashes in (False, True):
+            data = tree.serialize(with_hashes)
+            copy = TapTree().deserialize(BytesIO(data), verify=True)
+            self.assertEqual(copy.key.get_bytes(), tree.key.get_bytes())
+            self.assertEqual(copy.construct(), expected)
+            self.assertEqual(copy.serialize(with_hashes), data)
+        # Flip a bit in the first stored node hash, after the version,
+        # flags, key, leaf count and shape bytes.
+        data = bytearray(tree.serialize(True))
+        data[2 + 32 + 1 + 3] ^= 1
+        with self.assertRaises(Exception):
+            TapTree().deserialize(BytesIO(bytes(data)), verify=True)
+
+    def test_verify_taproot_commitments(self):
+        """Batch verification accepts valid control blocks and rejects a tampered one."""
+        tree, leaves = self._random_tree(6)
+        script, _, control_map = tree.construct()
+        output_key = bytes(script)[2:]
+        commitments = [(output_key, leaf.script, control_map[leaf.script]) for leaf in leaves]
+        self.assertTrue(verify_taproot_commitments(commitments))
+        script_, control = commitments[-1][1:]
+        tampered = bytearray(control)
+        tampered[-1] ^= 1
+        commitments[-1] = (output_key, script_, bytes(tampered))
+        self.assertFalse(verify_taproot_commitments(commitments))